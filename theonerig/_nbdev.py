@@ -12,6 +12,7 @@ index = {"DataChunk": "00_core.ipynb",
          "align_sync_timepoints": "01_utils.ipynb",
          "resample_to_timepoints": "01_utils.ipynb",
          "link_sync_timepoints": "01_utils.ipynb",
+         "shift_index_map": "01_utils.ipynb",
          "flip_stimulus": "01_utils.ipynb",
          "flip_gratings": "01_utils.ipynb",
          "stim_to_dataChunk": "01_utils.ipynb",
@@ -20,8 +21,10 @@ index = {"DataChunk": "00_core.ipynb",
          "get_calcium_stack_lenghts": "01_utils.ipynb",
          "twoP_dataChunks": "01_utils.ipynb",
          "img_2d_fit": "01_utils.ipynb",
+         "img_2d_fits": "01_utils.ipynb",
          "fill_nan": "01_utils.ipynb",
          "stim_inten_norm": "01_utils.ipynb",
+         "sliding_windows": "01_utils.ipynb",
          "group_direction_response": "01_utils.ipynb",
          "group_chirp_bumps": "01_utils.ipynb",
          "get_repeat_corrected": "01_utils.ipynb",
@@ -34,16 +37,21 @@ index = {"DataChunk": "00_core.ipynb",
          "format_pval": "01_utils.ipynb",
          "stim_recap_df": "01_utils.ipynb",
          "eyetrack_stim_inten": "02_processing.ipynb",
+         "eyetrack_stim_shifts": "02_processing.ipynb",
          "saccade_distances": "02_processing.ipynb",
          "smooth_eye_position": "02_processing.ipynb",
          "process_sta_batch": "02_processing.ipynb",
          "staEst_fromBins": "02_processing.ipynb",
+         "staEst_shift_test": "02_processing.ipynb",
          "process_sta_batch_large": "02_processing.ipynb",
+         "process_sta_batch_eyetrack": "02_processing.ipynb",
          "cross_correlation": "02_processing.ipynb",
+         "spike_correlograms": "02_processing.ipynb",
          "corrcoef": "02_processing.ipynb",
          "flatten_corrcoef": "02_processing.ipynb",
          "stimulus_ensemble": "02_processing.ipynb",
          "process_nonlinearity": "02_processing.ipynb",
+         "process_stc_batch": "02_processing.ipynb",
          "activity_histogram": "02_processing.ipynb",
          "cross_distances": "02_processing.ipynb",
          "cross_distances_sta": "02_processing.ipynb",
@@ -51,6 +59,7 @@ index = {"DataChunk": "00_core.ipynb",
          "paired_distances_sta": "02_processing.ipynb",
          "direction_selectivity": "02_processing.ipynb",
          "wave_direction_selectivity": "02_processing.ipynb",
+         "event_triggered_average": "02_processing.ipynb",
          "peri_saccadic_response": "02_processing.ipynb",
          "sigmoid": "03_modelling.ipynb",
          "gaussian": "03_modelling.ipynb",
@@ -159,18 +168,21 @@ index = {"DataChunk": "00_core.ipynb",
          "reverse_detection": "12_synchro.processing.ipynb",
          "extend_timepoints": "12_synchro.processing.ipynb",
          "error_check": "12_synchro.processing.ipynb",
+         "stream_frames": "12_synchro.processing.ipynb",
+         "detect_frames_stream": "12_synchro.processing.ipynb",
          "cluster_frame_signals": "12_synchro.processing.ipynb",
          "cluster_by_epochs": "12_synchro.processing.ipynb",
          "cluster_by_list": "12_synchro.processing.ipynb",
          "parse_time": "12_synchro.processing.ipynb",
          "get_position_estimate": "12_synchro.processing.ipynb",
          "match_starting_position": "12_synchro.processing.ipynb",
-         "display_match": "12_synchro.processing.ipynb",
+         "match_starting_positions": "12_synchro.processing.ipynb",
          "frame_error_correction": "12_synchro.processing.ipynb",
          "error_frame_matches": "12_synchro.processing.ipynb",
          "apply_shifts": "12_synchro.processing.ipynb",
          "shift_detection_conv": "12_synchro.processing.ipynb",
          "shift_detection_NW": "12_synchro.processing.ipynb",
+         "display_match": "12_synchro.processing.ipynb",
          "chop_stim_edges": "12_synchro.processing.ipynb",
          "detect_calcium_frames": "12_synchro.processing.ipynb",
          "get_dome_positions": "13_leddome.ipynb",
@@ -180,6 +192,7 @@ index = {"DataChunk": "00_core.ipynb",
          "build_wave_stimulus_array": "13_leddome.ipynb",
          "Quaternion": "13_leddome.ipynb",
          "get_waves_relative_position": "13_leddome.ipynb",
+         "get_waves_relative_positions": "13_leddome.ipynb",
          "get_led_relative_position": "13_leddome.ipynb",
          "load_vivo_2p": "99_testdata.ipynb"}
 
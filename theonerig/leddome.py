@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 13_leddome.ipynb (unless otherwise specified).
 
 __all__ = ['get_dome_positions', 'as_cartesian', 'as_spherical', 'angular_distance', 'build_wave_stimulus_array',
-           'Quaternion', 'get_waves_relative_position', 'get_led_relative_position']
+           'Quaternion', 'get_waves_relative_position', 'get_waves_relative_positions', 'get_led_relative_position']
 
 # Cell
 import numpy as np
@@ -339,6 +339,49 @@ def get_waves_relative_position(cell_sta_position, n_waves=100, mode="spherical"
     else:
         return np.array([(q[1], q[2], q[3]) for q in rotated_waves])
 
+def _pole_rotation_matrices(theta_led, phi_led):
+    """
+    Rotation matrices (equivalent to the rotation quaternions of `get_waves_relative_position`) bringing
+    the positions (theta_led, phi_led) to the pole (0,0). Computed for arrays of positions at once.
+    """
+    theta_led, phi_led = np.asarray(theta_led, dtype=float), np.asarray(phi_led, dtype=float)
+    theta_rot = np.pi/2; #Theta is fixed, corresponds to the plane touching the dome edge (elevation=0°)
+    phi_rot   = phi_led+np.pi/2
+    alpha_rot = -theta_led
+
+    tmp = np.sin(0.5*alpha_rot)
+    w   = np.cos(0.5*alpha_rot)
+    x, y, z = np.sin(theta_rot)*np.cos(phi_rot)*tmp, np.sin(theta_rot)*np.sin(phi_rot)*tmp, np.cos(theta_rot)*tmp
+    return np.stack([np.stack([1-2*(y*y+z*z), 2*(x*y-w*z),   2*(x*z+w*y)],   axis=-1),
+                     np.stack([2*(x*y+w*z),   1-2*(x*x+z*z), 2*(y*z-w*x)],   axis=-1),
+                     np.stack([2*(x*z-w*y),   2*(y*z+w*x),   1-2*(x*x+y*y)], axis=-1)], axis=-2)
+
+def get_waves_relative_positions(cells_sta_position, n_waves=100, mode="spherical"):
+    """
+    Rotate the waves origins to obtain for each cell position a spherical position of (0,0). Vectorized
+    version of `get_waves_relative_position` for multiple cells.
+    params:
+        - cells_sta_position: (theta, phi) positions of the cells in spherical coordinates, of shape (n_cell, 2)
+        - n_waves: Number of waves in the wave stimulus (positions/density of waves determined by this parameter)
+        - mode: One of ["spherical", "cartesian"], for the returned position
+    return:
+        - The rotated waves position of shape (n_cell, n_waves, 3)
+    """
+    assert mode in ["spherical", "cartesian"], 'Mode must be one of ["spherical", "cartesian"]'
+    cells_sta_position = np.asarray(cells_sta_position, dtype=float).reshape(-1, 2)
+    rot_matrices = _pole_rotation_matrices(cells_sta_position[:,0], cells_sta_position[:,1])
+
+    indexes       = np.arange(n_waves)+0.5
+    phis_wave     = np.pi*(1 + np.sqrt(5)) * indexes + np.pi/2  #Angle of rotation around the centre. Add pi/2 to correspond to the displayed wave positon
+    theta_wave    = np.arccos(1 - 2*indexes/n_waves)  #Distance angle from the centre
+    waves_xyz     = np.stack([np.sin(theta_wave)*np.cos(phis_wave), np.sin(theta_wave)*np.sin(phis_wave), np.cos(theta_wave)], axis=-1)
+
+    rotated_waves = np.einsum("cij,wj->cwi", rot_matrices, waves_xyz)
+    if mode=="spherical":
+        return as_spherical(rotated_waves.reshape(-1, 3)).reshape(rotated_waves.shape)
+    else:
+        return rotated_waves
+
 def get_led_relative_position(ref_led_flat_idx, mode="spherical"):
     """
     Rotate the LED positions to obtain for the ref_led_flat_idx a spherical position of (0,0)
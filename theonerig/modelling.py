@@ -70,7 +70,7 @@ def gaussian_2D(xz, sigma_x, sigma_z, amp, theta, x0, z0, y0):
         - y0: shift in y of the gaussian
     """
     (x,z) = xz
-    x0, z0 = float(x0), float(z0)
+    x0, z0 = np.asarray(x0, dtype=float), np.asarray(z0, dtype=float)
     a =  (np.cos(theta)**2)/(2*sigma_x**2) + (np.sin(theta)**2)/(2*sigma_z**2)
     b = -(np.sin(2*theta)) /(4*sigma_x**2) + (np.sin(2*theta)) /(4*sigma_z**2)
     c =  (np.sin(theta)**2)/(2*sigma_x**2) + (np.cos(theta)**2)/(2*sigma_z**2)
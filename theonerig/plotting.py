@@ -585,11 +585,8 @@ def plot_autocorrelogram(cluster, spike_times, spike_clusters, bin_ms=.001, samp
     if ax is None:
         fig, ax = plt.subplots()
 
-    cluster_mask = spike_clusters==cluster
-    cluster_times = spike_times[cluster_mask]
-    hist = np.histogram(cluster_times, bins=np.linspace(0,cluster_times[-1], int(cluster_times[-1]/(bin_ms*sampling_rate))))[0]
-    hist_tails = np.concatenate(([0]*tails, hist, [0]*tails))
-    corr = np.correlate(hist_tails, hist, mode="valid")
+    corr = spike_correlograms(spike_times, spike_clusters, clusters=[cluster],
+                              bin_size=bin_ms*sampling_rate, tails=tails)[0,0]
     corr[tails]=0
 
     ax.bar(np.linspace(-tails*bin_ms*1000,tails*bin_ms*1000,tails*2+1), corr, width=bin_ms*1000)
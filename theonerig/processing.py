@@ -1,9 +1,11 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 02_processing.ipynb (unless otherwise specified).
 
-__all__ = ['eyetrack_stim_inten', 'saccade_distances', 'smooth_eye_position', 'process_sta_batch', 'staEst_fromBins',
-           'process_sta_batch_large', 'cross_correlation', 'corrcoef', 'flatten_corrcoef', 'stimulus_ensemble',
-           'process_nonlinearity', 'activity_histogram', 'cross_distances', 'cross_distances_sta', 'paired_distances',
-           'paired_distances_sta', 'direction_selectivity', 'wave_direction_selectivity', 'peri_saccadic_response']
+__all__ = ['eyetrack_stim_inten', 'eyetrack_stim_shifts', 'saccade_distances', 'smooth_eye_position',
+           'process_sta_batch', 'staEst_fromBins', 'staEst_shift_test', 'process_sta_batch_large',
+           'process_sta_batch_eyetrack', 'cross_correlation', 'spike_correlograms', 'corrcoef', 'flatten_corrcoef',
+           'stimulus_ensemble', 'process_nonlinearity', 'process_stc_batch', 'activity_histogram', 'cross_distances',
+           'cross_distances_sta', 'paired_distances', 'paired_distances_sta', 'direction_selectivity',
+           'wave_direction_selectivity', 'event_triggered_average', 'peri_saccadic_response']
 
 # Cell
 from functools import partial
@@ -26,7 +28,7 @@ from .leddome import *
 def eyetrack_stim_inten(stim_inten, eye_track,
                         upsampling=2,
                         eye_calib=[[94 ,8], [ 18, 59]],
-                        box_w=None, box_h=None, stim_axis="x"):
+                        box_w=None, box_h=None, stim_axis="x", out=None, bs=1024):
     """
     From stimulus data and eye tracking, returns a corrected and upsampled stimulus data.
     Calibration corresponds to the width and height of the stimulus screen, in
@@ -40,20 +42,75 @@ def eyetrack_stim_inten(stim_inten, eye_track,
         - box_w: Width of a block in pixel (40px in case of a 32 box in width of a checkerboard on a 1280px width)
         - box_h: Height of a block in pixel. Both box_x and box_h are calculated from a 1280x720 screen if None
         - stim_axis: Specify which direction to shift in case of stim shape different than (t, y, x)
+        - out: Optional array of the upsampled shape (e.g. a np.memmap) in which to write the corrected stimulus
+        - bs: Maximum number of frames gathered at once
 
     return:
         - Upsampled and shift corrected stimulus intensity
     """
+    stim_shift_x, stim_shift_y = eyetrack_stim_shifts(stim_inten.shape, eye_track, upsampling=upsampling,
+                                                      eye_calib=eye_calib, box_w=box_w, box_h=box_h,
+                                                      stim_axis=stim_axis)
+    orig_shape = stim_inten.shape
+    len_t      = orig_shape[0]
+    if len(orig_shape)==3 and min(orig_shape[1:])>1:
+        up_shape   = (len_t, orig_shape[1]*upsampling, orig_shape[2]*upsampling)
+        up_factors = (upsampling, upsampling)
+        shifts     = np.stack((stim_shift_y, stim_shift_x), axis=1)
+    else: #Only the first spatial axis is upsampled and shifted
+        up_shape   = (len_t, orig_shape[1]*upsampling, *orig_shape[2:])
+        up_factors = (upsampling, 1)
+        shift_axis = stim_shift_x if stim_axis=="x" else stim_shift_y
+        shifts     = np.stack((shift_axis, np.zeros(len_t, dtype=int)), axis=1)
+        stim_inten = stim_inten.reshape(len_t, orig_shape[1], -1)
+    if out is None:
+        out = np.empty(up_shape, dtype=stim_inten.dtype)
+    out_3d = out.reshape(len_t, up_shape[1], -1)
+    len_0, len_1 = out_3d.shape[1:]
+
+    #After getting the shift of the matrix to apply, we roll the matrix instead of extending it to the shifts
+    #This seems strange, but from the cell point of view, that is potentially looking at no stimulus,
+    # the response it gives are uncorrelated with the stimulus, and so shouldn't impact further analysis
+    # Advantage is that it keeps the data small enough, without loosing regions of the stimulus.
+    #Upsampling and rolling are done together by indexing the original stimulus, once for all the frames sharing a shift
+    for (shift_0, shift_1), group_frames in zip(*_group_frames_by_shift(shifts)):
+        idx_0 = ((np.arange(len_0) - shift_0) % len_0) // up_factors[0]
+        idx_1 = ((np.arange(len_1) - shift_1) % len_1) // up_factors[1]
+        for start in range(0, len(group_frames), bs):
+            frames = group_frames[start:start+bs]
+            out_3d[frames] = stim_inten[np.ix_(frames, idx_0, idx_1)]
+
+    return out
+
+def eyetrack_stim_shifts(stim_shape, eye_track,
+                         upsampling=2,
+                         eye_calib=[[94 ,8], [ 18, 59]],
+                         box_w=None, box_h=None, stim_axis="x"):
+    """
+    Computes for each frame the shift to apply to the upsampled stimulus to correct for the eye movements.
+
+    params:
+        - stim_shape: Shape of the stimulus intensity matrix (t, y, x), or (t, x) or (t, y) depending on stim_axis
+        - eye_track: Eye tracking data of shape (t, x_pos, y_pos, ...)
+        - upsampling: Factor for the upsampling (2 will multiply by 2 number of box in width and height)
+        - eye_calib: Calibration matrix of shape (2,2)
+        - box_w: Width of a block in pixel (40px in case of a 32 box in width of a checkerboard on a 1280px width)
+        - box_h: Height of a block in pixel. Both box_x and box_h are calculated from a 1280x720 screen if None
+        - stim_axis: Specify which direction to shift in case of stim shape different than (t, y, x)
+
+    return:
+        - Tuple of integer arrays (shift_x, shift_y), of shape (t), in upsampled boxes
+    """
     eye_x, eye_y = eye_track[:,0], eye_track[:,1]
     shape_y, shape_x = 1, 1
-    if len(stim_inten.shape)==2:
+    if len(stim_shape)==2:
         if stim_axis=="x":
-            shape_x = stim_inten.shape[1]
+            shape_x = stim_shape[1]
         elif stim_axis=="y":
-            shape_y = stim_inten.shape[1]
-    elif len(stim_inten.shape)==3:
-        shape_y = stim_inten.shape[1]
-        shape_x = stim_inten.shape[2]
+            shape_y = stim_shape[1]
+    elif len(stim_shape)==3:
+        shape_y = stim_shape[1]
+        shape_x = stim_shape[2]
     if box_w is None:
         box_w = 1280//shape_x
     if box_h is None:
@@ -70,35 +127,25 @@ def eyetrack_stim_inten(stim_inten, eye_track,
                                   box_width=box_w,
                                   box_height=box_h)
 
-    if shape_y>1 and shape_x>1:
-        stim_inten = stim_inten.repeat(upsampling,axis=1).repeat(upsampling,axis=2)
-    else:
-        stim_inten = stim_inten.repeat(upsampling,axis=1)
-
     xpos_avg = np.mean(eye_x)
     ypos_avg = np.mean(eye_y)
-    mean_stim_inten = int((np.max(stim_inten)+np.min(stim_inten))/2)
-    #After getting the shift of the matrix to apply, we roll the matrix instead of extending it to the shifts
-    #This seems strange, but from the cell point of view, that is potentially looking at no stimulus,
-    # the response it gives are uncorrelated with the stimulus, and so shouldn't impact further analysis
-    # Advantage is that it keeps the data small enough, without loosing regions of the stimulus.
-    for i in range(len(stim_inten)):
-        x_eyeShift = eye_x[i]-xpos_avg
-        y_eyeShift = eye_y[i]-ypos_avg
-
-        stim_shift_x, stim_shift_y = eye_transfo_f(x_eyeShift=x_eyeShift,
-                                                   y_eyeShift=y_eyeShift)
-        if shape_y>1 and shape_x>1:
-            rolled_stim = np.roll(stim_inten[i],stim_shift_y,axis=0)
-            rolled_stim = np.roll(rolled_stim  ,stim_shift_x,axis=1)
-        else:
-            if stim_axis=="x":
-                rolled_stim = np.roll(stim_inten[i],stim_shift_x,axis=0)
-            else:
-                rolled_stim = np.roll(stim_inten[i],stim_shift_y,axis=0)
-        stim_inten[i] = rolled_stim
+    return eye_transfo_f(x_eyeShift=eye_x[:stim_shape[0]]-xpos_avg,
+                         y_eyeShift=eye_y[:stim_shape[0]]-ypos_avg)
+
+def _group_frames_by_shift(shifts):
+    """
+    Group the frames sharing the same shift.
+
+    params:
+        - shifts: Shifts of each frame of shape (t, n_axis)
 
-    return stim_inten
+    return:
+        - Unique shifts of shape (n_shift, n_axis)
+        - List of the frames index for each unique shift
+    """
+    unique_shifts, shift_group, counts = np.unique(shifts, axis=0, return_inverse=True, return_counts=True)
+    frames_sorted = np.argsort(shift_group.reshape(-1), kind="stable")
+    return unique_shifts, np.split(frames_sorted, np.cumsum(counts)[:-1])
 
 def saccade_distances(eye_track):
     """
@@ -180,18 +227,19 @@ def _linear_transform(box_dim, transfo_matrix, x_eyeShift, y_eyeShift):
     params:
         - box_dim: Size in pixel of the box [width, height]
         - transfo_matrix: Inverse matrix of the calibration matrix described in eyetrack_stim_inten
-        - x_eyeShift: Eye shift in x
-        - y_eyeShift: Eye shift in y
+        - x_eyeShift: Eye shift in x (single value or array)
+        - y_eyeShift: Eye shift in y (single value or array)
 
     return:
         - Stimulus shift tuple (delta_x, delta_y)
     """
-    transform_coord = np.dot(transfo_matrix, np.array([x_eyeShift, y_eyeShift]).T)
-    stim_vec        = np.round(transform_coord * box_dim).astype(int)
+    transform_coord = np.dot(transfo_matrix, np.array([x_eyeShift, y_eyeShift]))
+    stim_vec        = np.round((transform_coord.T * box_dim).T).astype(int)
     return stim_vec[0], -stim_vec[1]
 
 # Cell
-def process_sta_batch(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=False, normalisation="abs"):
+def process_sta_batch(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=False, normalisation="abs", dtype=None,
+                      n_shift=0, seed=1):
     """
     Computes the STA and associated pvalues in parallel for a batch of cells.
 
@@ -202,6 +250,11 @@ def process_sta_batch(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=False,
         - Fw: Lenght in frames of the forward window
         - return_pval: Flag to signal whether or not to return the pvalues
         - normalisation: Normalization applied to the STA. One of ["abs", "L2", None]
+        - dtype: Reduced precision for the computation (e.g. "float32"). Ternary stimuli are then kept in int8.
+        If None, computed in float64
+        - n_shift: Number of circularly time shifted spike trains used to compute empirical pvalues. If 0, the
+        pvalues assume a gaussian null distribution (not valid for correlated stimuli or calcium imaging data)
+        - seed: Seed of the random time shifts
 
     return:
         - stas of shape (n_cell, Hw+Fw, ...)
@@ -210,32 +263,62 @@ def process_sta_batch(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=False,
     assert normalisation in ["abs", "L2", None], "normalisation must be one of ['abs', 'L2', None]"
     #Preparing the stimulus
     orig_shape = stim_inten.shape
-    stim_inten = stim_inten_norm(stim_inten)
+    stim_inten = stim_inten_norm(stim_inten, dtype=dtype)
     sum_spikes = np.sum(spike_counts, axis=0)
     len_stim = len(stim_inten)
 
     #We just have to calculate one STA over the whole record
     stim_inten   = np.reshape(stim_inten, (len(stim_inten),-1))
     stim_inten   = np.transpose(stim_inten)
-    allCells_sta = staEst_fromBins(stim_inten, spike_counts, Hw, Fw=Fw)
+    p_values     = None
+    if return_pval and n_shift>0:
+        rng    = np.random.RandomState(seed) #Local generator, the global numpy random state is left untouched
+        shifts = rng.randint(Hw+Fw, len_stim-(Hw+Fw), size=n_shift)
+        allCells_sta, p_values = staEst_shift_test(stim_inten, spike_counts, shifts, Hw, Fw=Fw, dtype=dtype)
+    else:
+        allCells_sta = staEst_fromBins(stim_inten, spike_counts, Hw, Fw=Fw, dtype=dtype)
 
     if len(orig_shape)==3:
-        allCells_sta = allCells_sta.reshape((len(allCells_sta),Hw+Fw, orig_shape[-2], orig_shape[-1]))
+        sta_shape = (len(allCells_sta),Hw+Fw, orig_shape[-2], orig_shape[-1])
     elif len(orig_shape)==2:
-        allCells_sta = allCells_sta.reshape((len(allCells_sta),Hw+Fw,-1))
+        sta_shape = (len(allCells_sta),Hw+Fw,-1)
     else:
-        allCells_sta = allCells_sta.reshape((len(allCells_sta),Hw+Fw))
+        sta_shape = (len(allCells_sta),Hw+Fw)
+    allCells_sta = allCells_sta.reshape(sta_shape)
+    if p_values is not None:
+        p_values = p_values.reshape(sta_shape)
+
+    return _sta_postprocess(allCells_sta, sum_spikes, return_pval, normalisation, p_values=p_values)
+
+def _sta_postprocess(allCells_sta, sum_spikes, return_pval, normalisation, p_values=None):
+    """
+    Squeeze, compute the pvalues and normalize the STAs. Shared by the process_sta_batch functions.
 
+    params:
+        - allCells_sta: STAs of shape (n_cell, Hw+Fw, ...)
+        - sum_spikes: Number of spikes of each cell
+        - return_pval: Flag to signal whether or not to return the pvalues
+        - normalisation: Normalization applied to the STA. One of ["abs", "L2", None]
+        - p_values: Empirical pvalues of the STAs. If None, pvalues are computed assuming a gaussian null distribution
+
+    return:
+        - stas, or stas and pvalues if return_pval=True
+    """
+    empirical_pval = p_values is not None
     if allCells_sta.shape[0]==1: #Only one cell, but we need to keep the axis
         allCells_sta = np.squeeze(allCells_sta)
         allCells_sta = np.expand_dims(allCells_sta, axis=0)
+        if empirical_pval:
+            p_values = np.expand_dims(np.squeeze(p_values), axis=0)
     else:
         allCells_sta = np.squeeze(allCells_sta)
+        if empirical_pval:
+            p_values = np.squeeze(p_values)
 
-    if return_pval:
+    if return_pval and not empirical_pval:
         p_values = np.empty(allCells_sta.shape)
     for k, cell_sta in enumerate(allCells_sta): #Easy way to do normalization for each cell that works for all possible shapes
-        if return_pval:
+        if return_pval and not empirical_pval:
             z_scores    = cell_sta/ np.sqrt(1/sum_spikes[k]) #Standard score is calculated as (x-mean)/std
             p_values[k] = sp.stats.norm.sf(abs(z_scores))*2
 
@@ -251,37 +334,97 @@ def process_sta_batch(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=False,
     else:
         return allCells_sta
 
-def staEst_fromBins(stim, spike_counts, Hw, Fw=0):
+def _sta_weights(spike_counts, Hw, Fw=0, dtype=None):
     """
-    Matrix mutliplication to compute the STA. Use the wrapper process_sta_batch to avoid bugs.
+    Computes the weights of the frames in the STA from the cells activity: activity normalized by the total
+    activity and centered to 0 (to include "inhibitory" stimulus). The first Hw frames are excluded, as are
+    the last Fw frames for the forward window.
 
     params:
-        - stim_inten: stimulus intensity matrix of shape (flattened_frame, t)
         - spike_counts: cells activity matrix of shape (t, n_cell)
         - Hw: Lenght in frames of the history window, including the 0 timepoint
         - Fw: Lenght in frames of the forward window
+        - dtype: Precision of the weights. If None, float64 is used
 
     return:
-        - STA of shape (n_cell, Hw+Fw, flattened_frame)
+        - Tuple of weights for the history window and for the forward window, both of shape (t, n_cell)
     """
+    if dtype is None:
+        dtype = float
+    spike_counts = np.array(spike_counts, dtype=float)
     spike_counts[:Hw] = 0
-
     spike_counts = np.nan_to_num(spike_counts / np.sum(spike_counts,axis=0))
-    spike_counts = spike_counts - np.mean(spike_counts, axis=0) #Center to 0 the spike counts to include "inhibitory" stimulus
-    sta = np.zeros((Hw+Fw, stim.shape[0], spike_counts.shape[-1]))
-    for i in range(Hw): #Does the dot product of cell activity and frame intensity matrix
-        sta[(Hw-1-i),:,:] = np.dot(stim, spike_counts)
-        spike_counts      = np.roll(spike_counts, -1, axis=0) #And shift the activity to compute the next frame
-    spike_counts = np.roll(spike_counts, Hw, axis=0)
+    spike_counts = (spike_counts - np.mean(spike_counts, axis=0)).astype(dtype)
+    fw_counts    = spike_counts.copy()
     if Fw != 0:
-        spike_counts[-Fw:] = 0
-    for i in range(Fw): #Same thing for Fw
-        spike_counts  = np.roll(spike_counts, 1, axis=0)
-        sta[Hw+i,:,:] = np.dot(stim, spike_counts)
-    spike_counts = np.roll(spike_counts, -Fw, axis=0)
+        fw_counts[-Fw:] = 0
+    return spike_counts, fw_counts
+
+def staEst_fromBins(stim, spike_counts, Hw, Fw=0, dtype=None, bs=4096):
+    """
+    Matrix mutliplication to compute the STA. Use the wrapper process_sta_batch to avoid bugs.
+
+    params:
+        - stim_inten: stimulus intensity matrix of shape (flattened_frame, t)
+        - spike_counts: cells activity matrix of shape (t, n_cell)
+        - Hw: Lenght in frames of the history window, including the 0 timepoint
+        - Fw: Lenght in frames of the forward window
+        - dtype: Precision of the accumulation (e.g. "float32"). If None, float64 is used
+        - bs: Number of pixels cast to dtype at once, so a compact (int8) stimulus is never copied entirely
+
+    return:
+        - STA of shape (n_cell, Hw+Fw, flattened_frame)
+    """
+    if dtype is None:
+        dtype = float
+    spike_counts, fw_counts = _sta_weights(spike_counts, Hw, Fw=Fw, dtype=dtype)
+    len_t = len(spike_counts)
+    sta   = np.zeros((Hw+Fw, stim.shape[0], spike_counts.shape[-1]), dtype=dtype)
+    for start in range(0, stim.shape[0], bs):
+        stim_part = stim[start:start+bs].astype(dtype, copy=False)
+        for i in range(Hw): #Dot product of the frame intensity matrix with the cell activity shifted by i frames
+            # (same as rolling the activity of i frames backward, without copying it)
+            sta[(Hw-1-i), start:start+bs] = (stim_part[:, :len_t-i] @ spike_counts[i:]
+                                             + stim_part[:, len_t-i:] @ spike_counts[:i])
+        for i in range(1, Fw+1): #Same thing for Fw, shifting forward
+            sta[Hw-1+i, start:start+bs] = stim_part[:, i:] @ fw_counts[:len_t-i]
     return np.transpose(sta, (2,0,1))
 
-def process_sta_batch_large(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=False, normalisation="abs", bs=1000):
+def staEst_shift_test(stim, spike_counts, shifts, Hw, Fw=0, dtype=None, bs=16):
+    """
+    Computes the STA with empirical pvalues from a null distribution of STAs of circularly time shifted spike
+    trains. The shifted spike trains are stacked as extra cells of the same matrix multiplication, by
+    batches of bs shifts.
+
+    params:
+        - stim_inten: stimulus intensity matrix of shape (flattened_frame, t)
+        - spike_counts: cells activity matrix of shape (t, n_cell)
+        - shifts: Circular time shifts of the spike trains, in frames
+        - Hw: Lenght in frames of the history window, including the 0 timepoint
+        - Fw: Lenght in frames of the forward window
+        - dtype: Precision of the accumulation (e.g. "float32"). If None, float64 is used
+        - bs: Number of shifts computed together
+
+    return:
+        - STA of shape (n_cell, Hw+Fw, flattened_frame)
+        - pvalues of shape (n_cell, Hw+Fw, flattened_frame)
+    """
+    n_cell   = spike_counts.shape[1]
+    sta      = staEst_fromBins(stim, spike_counts, Hw, Fw=Fw, dtype=dtype) if len(shifts)==0 else None
+    n_exceed = 0
+    for start in range(0, len(shifts), bs):
+        shifted = [np.roll(spike_counts, shift, axis=0) for shift in shifts[start:start+bs]]
+        if sta is None: #The true STA is computed with the first batch
+            shifted.insert(0, spike_counts)
+        stas = staEst_fromBins(stim, np.concatenate(shifted, axis=1), Hw, Fw=Fw, dtype=dtype)
+        if sta is None:
+            sta, stas = stas[:n_cell], stas[n_cell:]
+        stas      = stas.reshape(-1, n_cell, *sta.shape[1:])
+        n_exceed += np.sum(np.abs(stas) >= np.abs(sta), axis=0)
+    return sta, (n_exceed+1)/(len(shifts)+1)
+
+def process_sta_batch_large(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=False, normalisation="abs", bs=1000,
+                            dtype=None):
     """
     Computes the STA and associated pvalues in parallel for a batch of cells, for a large stimulus.
 
@@ -293,6 +436,7 @@ def process_sta_batch_large(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=F
         - return_pval: Flag to signal whether or not to return the pvalues
         - normalisation: Normalization applied to the STA. One of ["abs", "L2", None]
         - bs: batch size to compute partial STA
+        - dtype: Reduced precision for the computation (e.g. "float32"). If None, computed in float64
 
     return:
         - stas of shape (n_cell, Hw+Fw, ...)
@@ -303,14 +447,14 @@ def process_sta_batch_large(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=F
 
     sum_spikes = np.sum(spike_counts, axis=0)
     len_stim = len(stim_inten)
-    allCells_sta = np.zeros((n_spatial_dim, spike_counts.shape[1], Hw+Fw))
+    allCells_sta = np.zeros((n_spatial_dim, spike_counts.shape[1], Hw+Fw), dtype=dtype)
     stim_inten = stim_inten.reshape((len_stim,-1))
     print("Computing the STA part by part:")
     for i, batch_pos in enumerate(range(0, n_spatial_dim, bs)):
         print(str(round(100*batch_pos/n_spatial_dim,2))+"%      ", end="\n", flush=True)
         #Computing STA on partial portions of the screen sequentially
-        stim_part = stim_inten_norm(stim_inten[:, batch_pos:batch_pos+bs]).T
-        sub_sta = staEst_fromBins(stim_part, spike_counts, Hw, Fw=Fw)
+        stim_part = stim_inten_norm(stim_inten[:, batch_pos:batch_pos+bs], dtype=dtype).T
+        sub_sta = staEst_fromBins(stim_part, spike_counts, Hw, Fw=Fw, dtype=dtype)
         allCells_sta[batch_pos:batch_pos+bs] = np.transpose(sub_sta, (2,0,1))#(ncell,Hw,stim_len) to (stim_len,ncell,Hw)
     allCells_sta = np.transpose(allCells_sta, (1,2,0))
     print("100%      ")
@@ -322,70 +466,197 @@ def process_sta_batch_large(stim_inten, spike_counts, Hw=30, Fw=2, return_pval=F
     else:
         allCells_sta = allCells_sta.reshape((len(allCells_sta),Hw+Fw))
 
-    if allCells_sta.shape[0]==1: #Only one cell, but we need to keep the axis
-        allCells_sta = np.squeeze(allCells_sta)
-        allCells_sta = np.expand_dims(allCells_sta, axis=0)
-    else:
-        allCells_sta = np.squeeze(allCells_sta)
+    return _sta_postprocess(allCells_sta, sum_spikes, return_pval, normalisation)
 
-    if return_pval:
-        p_values = np.empty(allCells_sta.shape)
-    for k, cell_sta in enumerate(allCells_sta): #Easy way to do normalization for each cell that works for all possible shapes
-        if return_pval:
-            z_scores    = cell_sta/ np.sqrt(1/sum_spikes[k]) #Standard score is calculated as (x-mean)/std
-            p_values[k] = sp.stats.norm.sf(abs(z_scores))*2
+def process_sta_batch_eyetrack(stim_inten, spike_counts, stim_shifts, Hw=30, Fw=2, return_pval=False,
+                               normalisation="abs", upsampling=2, stim_axis="x", dtype=None, bs=1024):
+    """
+    Computes the STA of a batch of cells in the upsampled and eye shift corrected stimulus space, without
+    generating the corrected stimulus (see `eyetrack_stim_inten`). Frames are grouped by shift, the STA
+    of each group is computed on the original stimulus, and then upsampled and shifted.
+    Gives the same result as `process_sta_batch(eyetrack_stim_inten(stim_inten, eye_track), spike_counts)`.
 
-        if normalisation is None:
-            continue
-        elif normalisation=="abs":
-            allCells_sta[k] = np.nan_to_num(cell_sta/np.max(np.abs(cell_sta)))
-        elif normalisation=="L2":
-            allCells_sta[k] = np.nan_to_num(cell_sta/np.sqrt(np.sum(np.power(cell_sta, 2))))
+    params:
+        - stim_inten: stimulus intensity matrix of shape (t, y, x), or (t, x) or (t, y) depending on stim_axis
+        - spike_counts: cells activity matrix of shape (t, n_cell)
+        - stim_shifts: Tuple (shift_x, shift_y) of the stimulus shifts of each frame, from `eyetrack_stim_shifts`
+        - Hw: Lenght in frames of the history window, including the 0 timepoint
+        - Fw: Lenght in frames of the forward window
+        - return_pval: Flag to signal whether or not to return the pvalues
+        - normalisation: Normalization applied to the STA. One of ["abs", "L2", None]
+        - upsampling: Factor for the upsampling used to compute the stim_shifts
+        - stim_axis: Specify which direction to shift in case of stim shape different than (t, y, x)
+        - dtype: Reduced precision for the computation (e.g. "float32"). If None, computed in float64
+        - bs: Maximum number of frames multiplied at once
 
-    if return_pval:
-        return allCells_sta, p_values
+    return:
+        - stas of shape (n_cell, Hw+Fw, y*upsampling, x*upsampling), or (n_cell, Hw+Fw, x*upsampling) ...
+        - stas and pvalues if return_pval=True, both of same shape
+    """
+    assert normalisation in ["abs", "L2", None], "normalisation must be one of ['abs', 'L2', None]"
+    if dtype is None:
+        dtype = float
+    orig_shape = stim_inten.shape
+    stim_inten = stim_inten_norm(stim_inten, dtype=dtype)
+    sum_spikes = np.sum(spike_counts, axis=0)
+    len_t, n_cell = spike_counts.shape
+
+    #Working in (t, y, x) with the upsampling factors of each axis
+    if len(orig_shape)==3 and min(orig_shape[1:])>1:
+        up_y, up_x = upsampling, upsampling
+    elif stim_axis=="x":
+        stim_inten = stim_inten.reshape(len_t, 1, -1)
+        up_y, up_x = 1, upsampling
     else:
-        return allCells_sta
+        stim_inten = stim_inten.reshape(len_t, -1, 1)
+        up_y, up_x = upsampling, 1
+    shape_y, shape_x = stim_inten.shape[1:]
+    stim_inten = stim_inten.reshape(len_t, -1)
+
+    spike_counts, fw_counts = _sta_weights(spike_counts, Hw, Fw=Fw, dtype=dtype)
+    #Offset of the frame weighting each frame of the stimulus, for each position in the window
+    lag_frames = np.concatenate((np.arange(Hw-1, -1, -1), np.arange(-1, -Fw-1, -1)))
+    is_hw      = np.arange(Hw+Fw) < Hw
+
+    shifts = np.stack((stim_shifts[1], stim_shifts[0]), axis=1) #(t, 2(y, x))
+    allCells_sta = np.zeros((shape_y*up_y, shape_x*up_x, Hw+Fw, n_cell), dtype=dtype)
+    for (shift_y, shift_x), group_frames in zip(*_group_frames_by_shift(shifts)):
+        group_sta    = np.zeros((shape_y*shape_x, (Hw+Fw)*n_cell), dtype=dtype)
+        for start in range(0, len(group_frames), bs):
+            frames   = group_frames[start:start+bs]
+            weighted = (frames[:, np.newaxis] + lag_frames) % len_t #(n_frame, Hw+Fw)
+            weights  = np.where(is_hw[:, np.newaxis], spike_counts[weighted], fw_counts[weighted])
+            group_sta += stim_inten[frames].astype(dtype, copy=False).T @ weights.reshape(len(frames), -1)
+        group_sta = group_sta.reshape(shape_y, shape_x, Hw+Fw, n_cell)
+        group_sta = group_sta.repeat(up_y, axis=0).repeat(up_x, axis=1)
+        allCells_sta += np.roll(group_sta, (shift_y, shift_x), axis=(0,1))
+
+    allCells_sta = np.transpose(allCells_sta, (3,2,0,1))
+    if len(orig_shape)==3:
+        allCells_sta = allCells_sta.reshape((n_cell, Hw+Fw, shape_y*up_y, shape_x*up_x))
+    else:
+        allCells_sta = allCells_sta.reshape((n_cell, Hw+Fw, -1))
+
+    return _sta_postprocess(allCells_sta, sum_spikes, return_pval, normalisation)
 
 # Cell
-def cross_correlation(spike_counts, tail_len=100):
+def cross_correlation(spike_counts, tail_len=100, dtype=None, upper=False):
     """
     From calculate the cross correlation of the cells over a time window.
+    All the pairs are computed together, with one matrix multiplication per time lag.
 
     params:
         - spike_counts of shape (t, n_cell)
         - tail_len: time correlation window size
+        - dtype: Reduced precision for the computation (e.g. "float32"). If None, computed in float64
+        - upper: If True, returns only the pairs of the upper triangle (diagonal included), in the order of
+        np.triu_indices(n_cell)
 
     return:
-        - cross correlation between the cells
+        - cross correlation between the cells of shape (n_cell, n_cell, tail_len*2+1), or (n_pair, tail_len*2+1)
+        if upper=True. corr[i,j,tail_len+lag] is the correlation of cell i with cell j shifted by lag, and
+        corr[j,i] is corr[i,j] reversed in time.
     """
+    if dtype is None:
+        dtype = float
     n_dpoints, n_cell = spike_counts.shape
-    corr_arr = np.zeros((n_cell,n_cell,tail_len+1))
-    spike_counts = (spike_counts / np.max(spike_counts, axis=0)) #Independant normalization of the cells
-    spike_counts_edged = np.concatenate((np.zeros((tail_len,n_cell)),
-                    spike_counts,
-                    np.zeros((tail_len,n_cell)))) #Creating an array with 0 tails on both side to use the valid mode
-                                                  # of numpy.correlate
-    for i in range(n_cell):
-        for j in range(i, n_cell):
-            corr_arr[i,j] = np.correlate(spike_counts_edged[:,i],
-                                         spike_counts[:,j],
-                                         mode="valid")
-            corr_arr[j,i] = corr_arr[i,j]
+    spike_counts = (spike_counts / np.max(spike_counts, axis=0)).astype(dtype) #Independant normalization of the cells
+
+    triu_idx = np.triu_indices(n_cell)
+    if upper:
+        corr_arr = np.zeros((len(triu_idx[0]), tail_len*2+1), dtype=dtype)
+    else:
+        corr_arr = np.zeros((n_cell, n_cell, tail_len*2+1), dtype=dtype)
+    for lag in range(-tail_len, tail_len+1):
+        if lag >= 0:
+            corr_lag = spike_counts[lag:].T @ spike_counts[:n_dpoints-lag]
+        else:
+            corr_lag = spike_counts[:n_dpoints+lag].T @ spike_counts[-lag:]
+        if upper:
+            corr_arr[:, tail_len+lag] = corr_lag[triu_idx]
+        else:
+            corr_arr[..., tail_len+lag] = corr_lag
     return corr_arr/n_dpoints
 
 # Cell
-def corrcoef(spike_counts):
+def spike_correlograms(spike_times, spike_clusters, clusters=None, bin_size=30, tails=30):
     """
-    Computes correlation coefficient between the cells
+    Computes the auto and cross-correlograms of clusters from their spike times, without binning the
+    spike trains. The spikes of all clusters are sorted together, and each spike is paired with the following
+    spikes in the correlogram window, so the cost is proportional to the number of spikes times their
+    number of neighbours in the window.
+
+    params:
+        - spike_times: Times of all spikes in phy format
+        - spike_clusters: cluster associated to the spikes in phy format
+        - clusters: Clusters for which to compute the correlograms. If None, all clusters are used
+        - bin_size: Size of the correlogram bins, in sampling points (30 -> 1ms at 30kHz)
+        - tails: Number of bins on each side of the correlograms
+
+    return:
+        - correlograms of shape (n_cluster, n_cluster, tails*2+1), in the order of clusters. corr[i,j,tails+lag]
+        counts the spikes of cluster i occuring lag bins after a spike of cluster j. Autocorrelograms are
+        on the diagonal, and don't count the pairing of a spike with itself.
+    """
+    if clusters is None:
+        clusters = np.unique(spike_clusters)
+    clusters = np.asarray(clusters)
+    n_cl, n_lag = len(clusters), tails*2+1
+
+    mask        = np.isin(spike_clusters, clusters)
+    order       = np.argsort(spike_times[mask], kind="stable")
+    spike_bins  = (spike_times[mask][order] // bin_size).astype(np.int64)
+    sorter      = np.argsort(clusters)
+    spike_cl    = sorter[np.searchsorted(clusters, spike_clusters[mask][order], sorter=sorter)]
+
+    flat_idx     = [] #Correlogram bins of the spike pairs, counted by a single bincount
+    in_window    = np.ones(len(spike_bins), dtype=bool) #Spikes still having neighbours in the window
+    for shift in range(1, len(spike_bins)):
+        diff        = spike_bins[shift:] - spike_bins[:-shift]
+        in_window   = in_window[:-1] & (diff <= tails)
+        if not in_window.any():
+            break
+        diff        = diff[in_window]
+        first_cl    = spike_cl[:-shift][in_window]
+        second_cl   = spike_cl[shift:][in_window]
+        flat_idx.append((second_cl*n_cl + first_cl)*n_lag + tails + diff)
+        flat_idx.append((first_cl*n_cl + second_cl)*n_lag + tails - diff)
+    flat_idx     = np.concatenate(flat_idx) if len(flat_idx)>0 else np.zeros(0, dtype=np.int64)
+    correlograms = np.bincount(flat_idx, minlength=n_cl*n_cl*n_lag)
+    return correlograms.reshape(n_cl, n_cl, n_lag)
+
+# Cell
+def corrcoef(spike_counts, dtype=None, bs=1024, condensed=False):
+    """
+    Computes correlation coefficient between the cells. The matrix is computed by blocks of cells,
+    so that the condensed form can be obtained without holding the full matrix in memory.
 
     params:
         - spike_counts: Cells activity of shape (t, n_cell)
+        - dtype: Reduced precision for the computation (e.g. "float32"). If None, computed in float64
+        - bs: Number of cells (rows of the matrix) computed at once
+        - condensed: If True, returns directly the flattened upper triangle (see `flatten_corrcoef`)
 
     return:
-        - Correlation matrix
+        - Correlation matrix of shape (n_cell, n_cell), or its upper triangle of shape (n_cell*(n_cell-1)/2)
     """
-    return np.corrcoef(spike_counts.T)
+    if dtype is None:
+        dtype = float
+    norm_counts  = np.array(spike_counts, dtype=dtype)
+    norm_counts -= np.mean(norm_counts, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"): #Cells with constant activity are set to nan, like np.corrcoef
+        norm_counts /= np.sqrt(np.sum(norm_counts**2, axis=0))
+    n_cell = norm_counts.shape[1]
+
+    corr_blocks = []
+    for start in range(0, n_cell, bs):
+        corr_block = np.clip(norm_counts[:, start:start+bs].T @ norm_counts, -1, 1)
+        if condensed:
+            corr_block = corr_block[np.triu_indices(len(corr_block), k=start+1, m=n_cell)]
+        corr_blocks.append(corr_block)
+    if condensed:
+        return np.concatenate(corr_blocks)
+    return np.concatenate(corr_blocks, axis=0)
 
 def flatten_corrcoef(corrcoef_matrix):
     """
@@ -396,13 +667,35 @@ def flatten_corrcoef(corrcoef_matrix):
 
     return:
         - flattened correlation matrix"""
-    shp = corrcoef_matrix.shape
-    return np.array([corrcoef_matrix[i,j] for i in range(shp[0]) for j in range(i+1, shp[0])])
+    return corrcoef_matrix[np.triu_indices(len(corrcoef_matrix), k=1)]
 
 # Cell
-def stimulus_ensemble(stim_inten, Hw=30, x=0, y=0, w=None, h=None):
+def _stim_window_blocks(stim_inten, Hw, bs=1024, dtype=None):
+    """
+    Generator of the stimulus ensemble by blocks of time, so that the ensemble is never held in memory.
+    Windows are views of the stimulus (sliding_windows), copied only one block at a time.
+
+    params:
+        - stim_inten: stimulus intensity matrix of shape (t, y, x)
+        - Hw: Lenght in frames of the history window, including the 0 timepoint
+        - bs: Number of windows per block
+        - dtype: Type to which the blocks are cast. If None, the stimulus type is kept
+
+    yield:
+        - Index of the first window of the block, and block of shape (n_window, Hw*y*x). Window i ends at frame i+Hw-1
+    """
+    if dtype is None:
+        dtype = stim_inten.dtype
+    windows = sliding_windows(stim_inten, Hw) #(t-(Hw-1), Hw, y, x)
+    for start in range(0, len(windows), bs):
+        #Contiguous copy, as a reshaped view would have overlapping rows (not handled by BLAS)
+        block = np.array(windows[start:start+bs], dtype=dtype)
+        yield start, block.reshape(len(block), -1)
+
+def stimulus_ensemble(stim_inten, Hw=30, x=0, y=0, w=None, h=None, bs=None, dtype=None, as_view=False):
     """
-    Generate the stimulus ensemble used to compute the nonlinearity
+    Generate the stimulus ensemble used to compute the nonlinearity. To avoid materializing the whole
+    flattened ensemble, it can be returned as a read-only view of the stimulus, or as a generator of blocks.
 
     params:
         - stim_inten: stimulus intensity matrix of shape (t, ...)
@@ -411,12 +704,16 @@ def stimulus_ensemble(stim_inten, Hw=30, x=0, y=0, w=None, h=None):
         - y: Up position of the window where to get the ensemble from
         - w: Width of the window where to get the ensemble from. If None, is set to stim_inten.shape[2]
         - h: Height of the window where to get the ensemble from. If None, is set to stim_inten.shape[1]
+        - bs: If not None, returns a generator of blocks of bs windows of the flattened ensemble
+        - dtype: Precision of the normalized stimulus and of the blocks (e.g. "float32"). If None, float64 is used
+        - as_view: If True, returns a read-only view of the ensemble of shape (len(stim_inten)-(Hw-1), Hw, h, w)
 
     return:
-        - Flatten stimulus ensemble of size (len(stim_inten)-(Hw-1), w*h*Hw). To obtain the corresponding cell activity,
-        slice it like so: slice(Hw-1, None)
+        - Flatten stimulus ensemble of size (len(stim_inten)-(Hw-1), w*h*Hw), or the view with as_view, or
+        generator of (index of the first window, flatten block of shape (n_window, Hw*h*w)) with bs.
+        To obtain the corresponding cell activity, slice it like so: slice(Hw-1, None)
     """
-    stim_inten = stim_inten_norm(stim_inten)
+    stim_inten = stim_inten_norm(stim_inten, dtype=dtype)
     if len(stim_inten.shape) == 1:
         stim_inten = stim_inten[..., np.newaxis, np.newaxis]
     elif len(stim_inten.shape) == 2:
@@ -428,21 +725,33 @@ def stimulus_ensemble(stim_inten, Hw=30, x=0, y=0, w=None, h=None):
         h = stim_inten.shape[1]
     xmin, xmax = max(0,x-w), min(stim_inten.shape[2], x+w+1)
     ymin, ymax = max(0,y-h), min(stim_inten.shape[1], y+h+1)
-    dtype = stim_inten.dtype
-    if np.all(np.in1d(stim_inten, [-1,0,1])):
-        dtype = "int8"
-    stim_ensmbl = np.zeros((len(stim_inten)-(Hw-1), (xmax-xmin)*(ymax-ymin)*Hw), dtype=dtype)
-    for i in range(0, len(stim_inten)-(Hw-1)):
-        flat_stim         = np.ndarray.flatten(stim_inten[i:i+Hw,
-                                                          ymin:ymax,
-                                                          xmin:xmax])
-        stim_ensmbl[i] = flat_stim
-    return stim_ensmbl
-
-def process_nonlinearity(stim_inten, spike_counts, bins, stas, p_norm=2):
-    """
-    Computes the nonlinearity of a single cell. The STA of the cell is in L2 normalization, which
+    if stim_inten.dtype != np.int8 and np.all(np.in1d(stim_inten, [-1,0,1])):
+        stim_inten = stim_inten.astype("int8")
+    stim_inten = stim_inten[:, ymin:ymax, xmin:xmax]
+
+    if bs is not None:
+        return _stim_window_blocks(stim_inten, Hw, bs=bs, dtype=dtype)
+    stim_ensmbl = sliding_windows(stim_inten, Hw) #Read-only view
+    if as_view:
+        return stim_ensmbl
+    return np.array(stim_ensmbl).reshape(len(stim_ensmbl), -1)
+
+def _histogram_index(values, bins):
+    """
+    Bin index of the values, following np.histogram conventions (last bin includes its right edge).
+    Values outside of the bins get the index -1.
+    """
+    idx = np.searchsorted(bins, values, side="right") - 1
+    idx[values==bins[-1]] = len(bins)-2
+    idx[idx>=len(bins)-1] = -1
+    return idx
+
+def process_nonlinearity(stim_inten, spike_counts, bins, stas, p_norm=2, dtype=None, bs=1024):
+    """
+    Computes the nonlinearity of a batch of cells. The STA of the cell is in L2 normalization, which
     should restrict the histogram values.
+    The stimulus ensemble is streamed by blocks of time, each block being projected on the STAs of all
+    cells at once, so the memory used is bounded by the block size.
 
     params:
         - stim_inten: stimulus intensity in shape (t, y, x)
@@ -452,54 +761,54 @@ def process_nonlinearity(stim_inten, spike_counts, bins, stas, p_norm=2):
         - p_norm: Power for the normalization. https://en.wikipedia.org/wiki/Norm_(mathematics)#p-norm :
             1 -> can compare nonlinearites of stimuli with different dimensionality
             2 -> Common L2 normalization for STAs
+        - dtype: Reduced precision for the computation (e.g. "float32"). If None, computed in float64
+        - bs: Number of frames processed at once
 
     return:
-        - nonlinearity of the cell.
+        - nonlinearities of the cells, of shape (n_cell, len(bins)-1)
     """
     assert len(stim_inten)==len(spike_counts)
-    stim_inten    = stim_inten_norm(np.array(stim_inten))
-
-    nonlins = np.empty((len(stas), len(bins)-1))
-
-    compute_with_dotprod = False
-    try:
-        stim_ensemble = stimulus_ensemble(stim_inten, Hw=stas.shape[1])
-        compute_with_dotprod = True
-    except MemoryError as err:
-        print("Not enough memory to generate the stimulus ensemble, "+
-              "computing nonlinearity with cross-correlation (will be slower)")
+    if dtype is None:
+        dtype = float
+    Hw = stas.shape[1]
 
     #In the case of calcium imaging, we have probabilities, not spike counts. Need to make it integers
     # The discretisation of the calcium imaging is done here globally (for all cells together)
-    # If it's not what you want, either do the discretisation inside the loop bellow, or discretise the S_matrix
-    # before passing it to this function
-
+    # If it's not what you want, discretise the S_matrix before passing it to this function
     if np.max(spike_counts)<1:
         mask         = np.where(spike_counts > 0)
         nonzero_min  = np.min(spike_counts[mask])
         discretized  = spike_counts/nonzero_min
         spike_counts = ((10*discretized)/(np.max(discretized))).astype(int)
 
-    spike_counts  = np.array(spike_counts)[stas.shape[1]-1:].astype(int)
-
-    for i, (sta, sp_count) in enumerate(zip(stas, spike_counts.T)):
-        sta /= np.power(np.sum(np.power(np.abs(sta), p_norm)), 1/p_norm) # p-norm
-
+    spike_counts  = np.array(spike_counts)[Hw-1:].astype(int)
+
+    n_cell, n_bin = len(stas), len(bins)-1
+    filters = np.array(stas, dtype=float).reshape(n_cell, -1)
+    with np.errstate(divide="ignore", invalid="ignore"): #Cells without spikes have a null STA
+        filters = filters / np.power(np.sum(np.power(np.abs(filters), p_norm), axis=1, keepdims=True), 1/p_norm) # p-norm
+    filters = filters.T.astype(dtype)
+
+    hist_all   = np.zeros(n_cell*n_bin)
+    hist_trigg = np.zeros(n_cell*n_bin)
+    offsets    = np.arange(n_cell)*n_bin
+    for start, block in stimulus_ensemble(np.array(stim_inten), Hw=Hw, bs=bs, dtype=dtype):
+        filtered_stim = block @ filters #(n_window, n_cell)
+        bin_idx       = _histogram_index(filtered_stim, bins)
+        valid         = bin_idx >= 0
+        flat_idx      = (bin_idx + offsets)[valid]
+        hist_all     += np.bincount(flat_idx, minlength=n_cell*n_bin)
+        hist_trigg   += np.bincount(flat_idx, weights=spike_counts[start:start+len(block)][valid],
+                                    minlength=n_cell*n_bin)
+    hist_all   = hist_all.reshape(n_cell, n_bin)
+    hist_trigg = hist_trigg.reshape(n_cell, n_bin)
+
+    nonlins = np.zeros((n_cell, n_bin))
+    for i, sp_count in enumerate(spike_counts.T):
         if not sp_count.any(): #No spikes
             continue
-
-        if compute_with_dotprod:
-            #This one is faster, but requires the stim_ensemble to fit the computer memory
-            filtered_stim = stim_ensemble@sta.reshape(-1)
-        else:
-            filtered_stim = np.squeeze(sp.signal.correlate(stim_inten, sta, mode="valid"))
-
-        filtered_sptrigg = np.repeat(filtered_stim, sp_count)
-
-        hist_all   = np.histogram(filtered_stim, bins=bins)[0]
-        hist_trigg = np.histogram(filtered_sptrigg, bins=bins)[0]
-
-        nonlin = hist_trigg/hist_all
+        with np.errstate(divide="ignore", invalid="ignore"):
+            nonlin = hist_trigg[i]/hist_all[i]
 
         if np.count_nonzero(~np.isnan(nonlin))<2: #Less than two values in the nonlin, cannot fill the gaps
             nonlin = np.nan_to_num(nonlin)
@@ -510,24 +819,148 @@ def process_nonlinearity(stim_inten, spike_counts, bins, stas, p_norm=2):
 
     return nonlins
 
-
 # Cell
-def activity_histogram(spike_counts):
+def process_stc_batch(stim_inten, spike_counts, Hw=10, stas=None, roi_size=None, n_eig=4, dtype=None, bs=1024,
+                      cell_bs=16, max_cov_size=2**26):
     """
-    Retrieve an histogram of the individual cells activity.
+    Computes the spike-triggered covariance (STC) of a batch of cells and returns its main eigenvectors.
+    The covariance of the stimulus ensemble is substracted from the STC, so that eigenvectors with
+    positive eigenvalues are excitatory features, and those with negative eigenvalues are suppressive.
+    The stimulus ensemble is streamed by blocks of time, and the cells sharing the same ROI are computed together,
+    by chunks of cell_bs cells to bound the number of covariance matrices accumulated at once.
+    Each chunk holds cell_bs*n_dim**2 values twice (accumulated and centered covariances), with
+    n_dim = Hw*h*w, plus cell_bs*n_dim*bs values for the weighted stimulus block. Without roi_size on a
+    large stimulus, n_dim is in the thousands and one covariance matrix alone takes tens of MB, so cell_bs
+    is reduced (down to 1 cell) to keep the covariances of a chunk under max_cov_size values.
 
     params:
+        - stim_inten: stimulus intensity matrix of shape (t, y, x), (t, n) or (t)
         - spike_counts: cells activity matrix of shape (t, n_cell)
+        - Hw: Lenght in frames of the history window, including the 0 timepoint
+        - stas: STAs of the cells of shape (n_cell, Hw', ...), used to center the ROI of each cell on its STA peak
+        - roi_size: Half size (h, w) of the ROI, of shape (h*2+1, w*2+1). If None, the whole stimulus is used
+        - n_eig: Number of eigenvectors returned per cell
+        - dtype: Reduced precision for the computation (e.g. "float32"). If None, computed in float64
+        - bs: Number of frames processed at once
+        - cell_bs: Number of cells whose covariance is accumulated at once
+        - max_cov_size: Maximum number of covariance values accumulated at once (2**26 is 512MB in float64)
 
     return:
-        - Cells activity histogram
+        - eigenvalues of shape (n_cell, n_eig), sorted by decreasing absolute value
+        - eigenvectors of shape (n_cell, n_eig, Hw, h, w)
+        - top left position (y, x) of the ROI of each cell, of shape (n_cell, 2)
     """
-    flat_spikes = spike_counts.reshape(-1)
-    flat_cell = np.array([[i]*spike_counts.shape[0] for i in range(spike_counts.shape[1])]).reshape(-1)
-    hist = np.histogram2d(flat_spikes, flat_cell, bins=[100,spike_counts.shape[1]])[0] / spike_counts.shape[0]
-    return hist
+    assert len(stim_inten)==len(spike_counts)
+    if dtype is None:
+        dtype = float
+    stim_inten = stim_inten_norm(np.array(stim_inten), dtype=dtype)
+    if len(stim_inten.shape) == 1:
+        stim_inten = stim_inten[..., np.newaxis, np.newaxis]
+    elif len(stim_inten.shape) == 2:
+        stim_inten = stim_inten[..., np.newaxis]
+    len_t, shape_y, shape_x = stim_inten.shape
+    n_cell = spike_counts.shape[1]
+    #Centered STA weights of the activity aligned to the end of the windows. Summed over the ensemble, they give
+    # the STAs, and the difference between the spike triggered and the stimulus ensemble second moments
+    weights, _ = _sta_weights(np.array(spike_counts)[Hw-1:], 0, dtype=dtype)
+
+    if roi_size is None:
+        roi_h, roi_w = shape_y, shape_x
+        rois = np.zeros((n_cell, 2), dtype=int)
+    else:
+        assert stas is not None, "The STAs are needed to position the ROIs"
+        roi_h, roi_w = min(roi_size[0]*2+1, shape_y), min(roi_size[1]*2+1, shape_x)
+        stas = np.reshape(stas, (n_cell, -1, shape_y, shape_x))
+        peaks = np.array([np.unravel_index(np.argmax(np.abs(sta)), sta.shape)[1:] for sta in stas])
+        #ROIs are kept inside the stimulus, so they all have the same size
+        rois = np.stack((np.clip(peaks[:,0]-roi_size[0], 0, shape_y-roi_h),
+                         np.clip(peaks[:,1]-roi_size[1], 0, shape_x-roi_w)), axis=1)
+
+    n_dim   = Hw*roi_h*roi_w
+    cell_bs = max(1, min(cell_bs, max_cov_size // n_dim**2))
+    eig_vals = np.zeros((n_cell, n_eig))
+    eig_vecs = np.zeros((n_cell, n_eig, Hw, roi_h, roi_w))
+    unique_rois, roi_group = np.unique(rois, axis=0, return_inverse=True)
+    for g, (roi_y, roi_x) in enumerate(unique_rois):
+        roi_stim = stim_inten[:, roi_y:roi_y+roi_h, roi_x:roi_x+roi_w]
+        cells    = np.where(roi_group.reshape(-1)==g)[0]
+        for cell_start in range(0, len(cells), cell_bs):
+            chunk_cells = cells[cell_start:cell_start+cell_bs]
+            sum_x   = np.zeros(n_dim, dtype=dtype)
+            sta     = np.zeros((n_dim, len(chunk_cells)), dtype=dtype)
+            sum_wxx = np.zeros((len(chunk_cells), n_dim, n_dim), dtype=dtype)
+            for start, block in _stim_window_blocks(roi_stim, Hw, bs=bs, dtype=dtype):
+                block_weights = weights[start:start+len(block), chunk_cells]
+                sum_x   += np.sum(block, axis=0)
+                sta     += block.T @ block_weights
+                sum_wxx += np.matmul(block.T * block_weights.T[:, np.newaxis], block) #Batched weighted GEMMs
+            mean_x   = (sum_x / len(weights)).astype(float) #Stimulus ensemble mean
+            mean_s   = sta.T.astype(float) + mean_x         #Spike triggered means
+            #STC minus the stimulus ensemble covariance
+            cov_diff = (sum_wxx - mean_s[:, :, np.newaxis] * mean_s[:, np.newaxis, :]) + np.outer(mean_x, mean_x)
+            for k, cell in enumerate(chunk_cells):
+                vals, vecs = np.linalg.eigh(cov_diff[k])
+                order = np.argsort(np.abs(vals))[::-1][:n_eig]
+                eig_vals[cell, :len(order)] = vals[order]
+                eig_vecs[cell, :len(order)] = vecs[:, order].T.reshape(-1, Hw, roi_h, roi_w)
+
+    return eig_vals, eig_vecs, rois
 
 # Cell
+def activity_histogram(spike_counts, bins=100, value_range=None):
+    """
+    Retrieve an histogram of the individual cells activity. All the cells share the same bins, and the
+    histograms are filled with a single bincount per chunk of activity.
+
+    params:
+        - spike_counts: cells activity matrix of shape (t, n_cell), or an iterable of chunks of shape (t_chunk, n_cell)
+        - bins: Number of bins of the histograms
+        - value_range: (min, max) range of the bins. If None, the range of spike_counts is used (requires an array)
+
+    return:
+        - Cells activity histogram of shape (bins, n_cell), normalized by the number of timepoints
+    """
+    if isinstance(spike_counts, np.ndarray):
+        if value_range is None:
+            value_range = (np.min(spike_counts), np.max(spike_counts))
+        spike_counts = [spike_counts]
+    assert value_range is not None, "value_range must be given to compute the histogram of chunks"
+    if value_range[0] == value_range[1]: #Same convention as np.histogram
+        value_range = (value_range[0]-.5, value_range[1]+.5)
+    edges = np.linspace(value_range[0], value_range[1], bins+1)
+
+    hist, len_t = 0, 0
+    for chunk in spike_counts:
+        n_cell   = chunk.shape[1]
+        bin_idx  = _histogram_index(chunk, edges)
+        valid    = bin_idx >= 0
+        flat_idx = (bin_idx*n_cell + np.arange(n_cell))[valid]
+        hist    += np.bincount(flat_idx, minlength=bins*n_cell)
+        len_t   += len(chunk)
+    if len_t == 0:
+        raise ValueError("spike_counts is empty: no timepoint to compute the histogram from")
+    return hist.reshape(bins, -1) / len_t
+
+# Cell
+def _center_of_mass(masks):
+    """
+    Centers of mass (y, x) of a stack of masks of shape (n_mask, y, x), computed with one weighted sum
+    like `ndimage.center_of_mass`.
+    """
+    masks = np.asarray(masks, dtype=float)
+    total = np.sum(masks, axis=(1,2))
+    center_y = np.sum(masks, axis=2) @ np.arange(masks.shape[1]) / total
+    center_x = np.sum(masks, axis=1) @ np.arange(masks.shape[2]) / total
+    return np.stack((center_y, center_x), axis=1)
+
+def _sta_fit_masks(fits, sta_shape, f):
+    """
+    Binary masks of STA fits, thresholded at -.5 or .5 depending on the polarity of the fit.
+    """
+    sta_masks = img_2d_fits(sta_shape, fits, f)
+    negative  = np.abs(np.min(sta_masks, axis=(1,2))) > np.max(sta_masks, axis=(1,2))
+    return np.where(negative[:, np.newaxis, np.newaxis], sta_masks < -.5, sta_masks > .5)
+
 def cross_distances(masks):
     """
     Computes cross distances from the center of mass of a list of mask.
@@ -538,13 +971,8 @@ def cross_distances(masks):
     return:
         - cross distances matrix
     """
-    center_mass = np.array([ndimage.measurements.center_of_mass(mask) for mask in masks])
-    cross_distances = np.zeros((len(masks),len(masks)))
-    for i in range(len(masks)):
-        for j in range(i,len(masks)):
-            cross_distances[i,j] = np.linalg.norm(center_mass[i]-center_mass[j])
-            cross_distances[j,i] = cross_distances[i,j]
-    return cross_distances
+    center_mass = _center_of_mass(masks)
+    return np.linalg.norm(center_mass[:, np.newaxis] - center_mass[np.newaxis], axis=-1)
 
 def cross_distances_sta(fits, sta_shape, f):
     """
@@ -558,13 +986,7 @@ def cross_distances_sta(fits, sta_shape, f):
     return:
         - cross distances matrix
     """
-    sta_masks = np.array([img_2d_fit(sta_shape, fit, f) for fit in fits])
-    for i,sta_mask in enumerate(sta_masks):
-        if abs(np.min(sta_mask)) > np.max(sta_mask):
-            sta_masks[i] = sta_mask < -.5
-        else:
-            sta_masks[i] = sta_mask > .5
-    return cross_distances(sta_masks)
+    return cross_distances(_sta_fit_masks(fits, sta_shape, f))
 
 def paired_distances(masks_1, masks_2):
     """
@@ -577,12 +999,7 @@ def paired_distances(masks_1, masks_2):
     return:
         - distance between the two masks
     """
-    center_mass_1 = np.array([ndimage.measurements.center_of_mass(mask) for mask in masks_1])
-    center_mass_2 = np.array([ndimage.measurements.center_of_mass(mask) for mask in masks_2])
-    paired_distances = np.zeros(len(masks_1))
-    for i, (center_1, center_2) in enumerate(zip(masks_1, masks_2)):
-        paired_distances[i] = np.linalg.norm(center_1-center_2)
-    return paired_distances
+    return np.linalg.norm(_center_of_mass(masks_1) - _center_of_mass(masks_2), axis=1)
 
 def paired_distances_sta(sta_fits_1, sta_fits_2, sta_shape, f):
     """
@@ -597,22 +1014,10 @@ def paired_distances_sta(sta_fits_1, sta_fits_2, sta_shape, f):
     return:
         - distance between the two STAs
     """
-    sta_masks_1 = np.array([img_2d_fit(sta_shape, fit, f) for fit in sta_fits_1])
-    for i,sta_mask in enumerate(sta_masks_1):
-        if abs(np.min(sta_mask)) > np.max(sta_mask):
-            sta_masks_1[i] = sta_mask < -.5
-        else:
-            sta_masks_1[i] = sta_mask > .5
-    sta_masks_2 = np.array([img_2d_fit(sta_shape, fit, f) for fit in sta_fits_2])
-    for i,sta_mask in enumerate(sta_masks_2):
-        if abs(np.min(sta_mask)) > np.max(sta_mask):
-            sta_masks_2[i] = sta_mask < -.5
-        else:
-            sta_masks_2[i] = sta_mask > .5
-    return paired_distances(sta_masks_1, sta_masks_2)
+    return paired_distances(_sta_fit_masks(sta_fits_1, sta_shape, f), _sta_fit_masks(sta_fits_2, sta_shape, f))
 
 # Cell
-def direction_selectivity(grouped_spikes_d, n_bootstrap=1000):
+def direction_selectivity(grouped_spikes_d, n_bootstrap=1000, seed=1):
     """
     Compute the direction selectivity index of cells in the given dict containing for each condition as
     the keys, an array of shape (n_angle, n_repeat, trial_len, n_cell). Such dictionnary can be obtained
@@ -621,6 +1026,7 @@ def direction_selectivity(grouped_spikes_d, n_bootstrap=1000):
     params:
         - grouped_spikes_d: Results of the group_direction_response of shape (n_angle, n_repeat, t, n_cell)
         - n_bootstrap: Number of bootstrap iteration to calculate the p-value
+        - seed: Seed of the trials shuffling
 
     return:
         - A dictionnary with a key for each condition retrieving a tuple containing list of the cells
@@ -644,23 +1050,18 @@ def direction_selectivity(grouped_spikes_d, n_bootstrap=1000):
         ori_pref  = np.nan_to_num((vect_ori * sum_rep_spike).sum(axis=1) / sum_rep_spike.sum(axis=1))
         ori_idx   = abs(ori_pref)
 
-        #Generating direction and orientation index from shuffled trials
-        axtup_l = list(itertools.product(range(sp_count.shape[0]), range(sp_count.shape[1])))
-        random.seed(1)
-        axtup_l_shuffled = axtup_l.copy()
-        rand_ori_idx_l = np.empty((n_bootstrap, sp_count.shape[3]))
-        rand_dir_idx_l = np.empty((n_bootstrap, sp_count.shape[3]))
-        for i in range(n_bootstrap):
-            random.shuffle(axtup_l_shuffled)
-            shuffled_sp_count = np.empty(sp_count.shape)
-            for axtup, axtup_shuff in zip(axtup_l, axtup_l_shuffled):
-                shuffled_sp_count[axtup] = sp_count[axtup_shuff]
-            rand_sum_rep_spike      = np.sum(shuffled_sp_count, axis=(1,2)).T
-            rand_dir_pref     = np.nan_to_num((vect_dir * rand_sum_rep_spike).sum(axis=1) / rand_sum_rep_spike.sum(axis=1))
-            rand_dir_idx_l[i] = abs(rand_dir_pref)
-
-            rand_ori_pref     = np.nan_to_num((vect_ori * rand_sum_rep_spike).sum(axis=1) / rand_sum_rep_spike.sum(axis=1))
-            rand_ori_idx_l[i] = abs(rand_ori_pref)
+        #Generating direction and orientation index from shuffled trials. Each trial is reduced to its spike sum,
+        # and shuffling the trials amounts to giving them the angle vector of the position they are shuffled to
+        n_repeat    = sp_count.shape[1]
+        trial_sums  = np.sum(sp_count, axis=2).reshape(n_angle*n_repeat, -1) #(n_trial, n_cell)
+        rng          = np.random.RandomState(seed) #Local generator, the global numpy random state is left untouched
+        permutations = np.argsort(rng.rand(n_bootstrap, len(trial_sums)), axis=1)
+        rand_vects   = np.empty((2, n_bootstrap, len(trial_sums)), dtype=complex)
+        np.put_along_axis(rand_vects[0], permutations, np.repeat(vect_dir, n_repeat)[np.newaxis], axis=1)
+        np.put_along_axis(rand_vects[1], permutations, np.repeat(vect_ori, n_repeat)[np.newaxis], axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rand_prefs = np.nan_to_num((rand_vects @ trial_sums) / np.sum(trial_sums, axis=0))
+        rand_dir_idx_l, rand_ori_idx_l = np.abs(rand_prefs)
 
         #Same calculation of pval as in Baden et al 2016
         p_val_dir = 1 - (np.sum(rand_dir_idx_l<ds_idx, axis=0)/n_bootstrap)
@@ -681,6 +1082,7 @@ def direction_selectivity(grouped_spikes_d, n_bootstrap=1000):
 def wave_direction_selectivity(wave_array, spike_counts, moving_distance_th=1, looming_distance_th=.3, n_bootstrap=1000):
     """
     Computes the direction, orientation and looming/shrinking indexes of the cells in response to the wave stimulus (in LED dome).
+    The bootstrap shuffles are shared by all cells and applied to the response matrix of all cells at once.
 
     params:
         - wave_array: The indexes of the waves from the record master.
@@ -720,71 +1122,58 @@ def wave_direction_selectivity(wave_array, spike_counts, moving_distance_th=1, l
     summed_responses = summed_responses.T
 
     dome_positions = get_dome_positions(mode="spherical")
-
-    ori_pref_l, dir_pref_l              = [], []
-    ori_idx_l, dir_idx_l, loom_idx_l    = [], [], []
-    ori_pval_l, dir_pval_l, loom_pval_l = [], [], []
-    stas_position_l, waves_position_l   = [], []
-
-    for sta, cell_responses  in zip(stas_wave, summed_responses):
-        maxidx_sta     = np.argmax(np.abs(sta))
-        theta_led      = dome_positions[maxidx_sta//237,maxidx_sta%237,1]
-        phi_led        = dome_positions[maxidx_sta//237,maxidx_sta%237,2]
-        relative_waves = get_waves_relative_position((theta_led, phi_led), mode="spherical")
-
-        stas_position_l.append((theta_led, phi_led))
-        waves_position_l.append(relative_waves)
-
-        waves_distance = relative_waves[:,1]
-        waves_angle    = (relative_waves[:,2]+tau)%(tau) #Set the angle in the (0,2pi) range
-
-        looming_mask   = (waves_distance<looming_distance_th)
-        shrink_mask    = (waves_distance>np.pi-looming_distance_th)
-        waves_mask     = (waves_distance>moving_distance_th) & (waves_distance<np.pi-moving_distance_th)
-
-        vectors_dir  = np.exp(waves_angle*1j)  #Create vectors using imaginary numbers
-        vectors_ori  = np.exp(waves_angle*1j*2)#x2 gather the vectors with opposite directions
-        dir_pref     = np.nan_to_num((vectors_dir[waves_mask] * cell_responses[waves_mask]).sum() / cell_responses[waves_mask].sum())
-        ori_pref     = np.nan_to_num((vectors_ori[waves_mask] * cell_responses[waves_mask]).sum() / cell_responses[waves_mask].sum())
-        ds_idx       = abs(dir_pref)
-        os_idx       = abs(ori_pref)
-
-        looming_response   = (cell_responses[looming_mask]).sum()
-        shrinking_response = (cell_responses[shrink_mask]).sum()
-        looming_idx        = (looming_response-shrinking_response)/(looming_response+shrinking_response)
-
-        ori_pref_l.append(ori_pref); dir_pref_l.append(dir_pref)
-        ori_idx_l.append(os_idx); dir_idx_l.append(ds_idx)
-        loom_idx_l.append(looming_idx)
-
-        np.random.seed(1)
-        rand_ori_idx_l  = np.empty(n_bootstrap)
-        rand_dir_idx_l  = np.empty(n_bootstrap)
-        rand_loom_idx_l = np.empty(n_bootstrap)
-        for i in range(n_bootstrap):
-            shuffled_response = cell_responses.copy()
-            np.random.shuffle(shuffled_response)
-
-            rand_dir_pref     = np.nan_to_num((vectors_dir[waves_mask] * shuffled_response[waves_mask]).sum() / shuffled_response[waves_mask].sum())
-            rand_ori_pref     = np.nan_to_num((vectors_ori[waves_mask] * shuffled_response[waves_mask]).sum() / shuffled_response[waves_mask].sum())
-            rand_dir_idx_l[i] = abs(rand_dir_pref)
-            rand_ori_idx_l[i] = abs(rand_ori_pref)
-
-            rand_looming_response   = (shuffled_response[looming_mask]).sum()
-            rand_shrinking_response = (shuffled_response[shrink_mask]).sum()
-            rand_loom_idx_l[i]      = (rand_looming_response-rand_shrinking_response)/(rand_looming_response+rand_shrinking_response)
-
-        #Same calculation of pval as in Baden et al 2016
-        p_val_dir  = 1 - (np.sum(rand_dir_idx_l<ds_idx)/n_bootstrap)
-        p_val_ori  = 1 - (np.sum(rand_ori_idx_l<os_idx)/n_bootstrap)
-        p_val_loom = 1 - (np.sum(np.abs(rand_loom_idx_l)<abs(looming_idx))/n_bootstrap)
-
-        ori_pval_l.append(p_val_ori); dir_pval_l.append(p_val_dir); loom_pval_l.append(p_val_loom)
-
-        # original orientation, by divinding the phase of the vector by two
-        polar_ori_pref = polar(ori_pref)
-        new_vector     = ((polar_ori_pref[1]+tau)%tau)/2 #Convert to positive radian angle and divide by two
-        ori_pref       = rect(polar_ori_pref[0], new_vector)
+    maxidx_stas    = np.argmax(np.abs(stas_wave.reshape(len(stas_wave), -1)), axis=1)
+    theta_leds     = dome_positions[maxidx_stas//237, maxidx_stas%237, 1]
+    phi_leds       = dome_positions[maxidx_stas//237, maxidx_stas%237, 2]
+    relative_waves = get_waves_relative_positions(np.stack([theta_leds, phi_leds], axis=1), mode="spherical")
+    stas_position_l  = list(zip(theta_leds, phi_leds))
+    waves_position_l = list(relative_waves)
+
+    waves_distance = relative_waves[...,1]
+    waves_angle    = (relative_waves[...,2]+tau)%(tau) #Set the angle in the (0,2pi) range
+
+    looming_mask   = (waves_distance<looming_distance_th)
+    shrink_mask    = (waves_distance>np.pi-looming_distance_th)
+    waves_mask     = (waves_distance>moving_distance_th) & (waves_distance<np.pi-moving_distance_th)
+
+    vectors_dir  = np.exp(waves_angle*1j) * waves_mask  #Create vectors using imaginary numbers
+    vectors_ori  = np.exp(waves_angle*1j*2) * waves_mask #x2 gather the vectors with opposite directions
+    #Wave weights of shape (n_cell, n_waves, 5): direction, orientation, moving waves, looming and shrinking
+    wave_weights = np.stack([vectors_dir, vectors_ori, waves_mask, looming_mask, shrink_mask], axis=-1)
+
+    def _selectivity_indexes(responses, wave_weights):
+        #Responses of shape (n_cell, ..., n_waves) -> indexes of shape (n_cell, ...)
+        sums = np.matmul(responses.astype(complex), wave_weights)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dir_pref = np.nan_to_num(sums[...,0] / sums[...,2].real)
+            ori_pref = np.nan_to_num(sums[...,1] / sums[...,2].real)
+            loom_idx = (sums[...,3].real-sums[...,4].real)/(sums[...,3].real+sums[...,4].real)
+        return dir_pref, ori_pref, loom_idx
+
+    dir_pref, ori_pref, looming_idx = _selectivity_indexes(summed_responses[:, np.newaxis], wave_weights)
+    dir_pref, ori_pref, looming_idx = dir_pref[:,0], ori_pref[:,0], looming_idx[:,0]
+    ds_idx, os_idx = np.abs(dir_pref), np.abs(ori_pref)
+
+    #Permutations shared by all cells (same sequence as shuffling each cell's responses after seeding)
+    rng          = np.random.RandomState(1) #Local generator, the global numpy random state is left untouched
+    permutations = np.array([rng.permutation(summed_responses.shape[1]) for _ in range(n_bootstrap)])
+    n_exceed_dir, n_exceed_ori, n_exceed_loom = [np.zeros(len(summed_responses), dtype=int) for _ in range(3)]
+    for start in range(0, len(summed_responses), 64): #By batches of cells to bound the memory
+        cells = slice(start, start+64)
+        rand_dir_pref, rand_ori_pref, rand_loom_idx = _selectivity_indexes(summed_responses[cells][:, permutations],
+                                                                           wave_weights[cells])
+        n_exceed_dir[cells]  = np.sum(np.abs(rand_dir_pref)<ds_idx[cells, np.newaxis], axis=1)
+        n_exceed_ori[cells]  = np.sum(np.abs(rand_ori_pref)<os_idx[cells, np.newaxis], axis=1)
+        n_exceed_loom[cells] = np.sum(np.abs(rand_loom_idx)<np.abs(looming_idx[cells, np.newaxis]), axis=1)
+
+    #Same calculation of pval as in Baden et al 2016
+    dir_pval_l  = list(1 - n_exceed_dir/n_bootstrap)
+    ori_pval_l  = list(1 - n_exceed_ori/n_bootstrap)
+    loom_pval_l = list(1 - n_exceed_loom/n_bootstrap)
+
+    dir_pref_l, dir_idx_l = list(dir_pref), list(ds_idx)
+    ori_pref_l, ori_idx_l = list(ori_pref), list(os_idx)
+    loom_idx_l            = list(looming_idx)
 
     return (summed_responses,
             dir_pref_l, dir_idx_l, dir_pval_l,
@@ -793,10 +1182,47 @@ def wave_direction_selectivity(wave_array, spike_counts, moving_distance_th=1, l
             stas_position_l, waves_position_l)
 
 # Cell
-def peri_saccadic_response(spike_counts, eye_track, motion_threshold=5, window=15):
+def event_triggered_average(traces, event_frames, pre, post, weights=None, return_trials=False):
     """
+    Computes the average of traces around events. All the windows are gathered at once with a single
+    fancy indexing of the traces. Events too close to the traces edges for their window to fit are excluded.
 
+    params:
+        - traces: Traces of shape (t, ...), e.g. the cells activity matrix of shape (t, n_cell)
+        - event_frames: Frame indexes of the events
+        - pre: Number of frames before the events in the window
+        - post: Number of frames after the events in the window, including the event frame
+        - weights: Weights of the events. If None, all events have the same weight
+        - return_trials: If True, also returns the windows of all the (non excluded) events
 
+    return:
+        - Average of shape (pre+post, ...)
+        - Standard error of the mean of shape (pre+post, ...)
+        - If return_trials, windows of shape (n_event, pre+post, ...)
+    """
+    traces       = np.asarray(traces)
+    event_frames = np.asarray(event_frames, dtype=int)
+    weights      = np.ones(len(event_frames)) if weights is None else np.asarray(weights, dtype=float)
+    assert len(weights)==len(event_frames), "There must be one weight per event"
+
+    valid        = (event_frames >= pre) & (event_frames+post <= len(traces))
+    event_frames, weights = event_frames[valid], weights[valid]
+    trials       = traces[event_frames[:, np.newaxis] + np.arange(-pre, post)] #(n_event, pre+post, ...)
+
+    w_shape  = (-1,) + (1,)*(trials.ndim-1)
+    w_sum    = np.sum(weights)
+    with np.errstate(divide="ignore", invalid="ignore"): #No or a single event gives nan
+        average  = np.sum(trials * weights.reshape(w_shape), axis=0) / w_sum
+        #Unbiased weighted variance (reliability weights), equal to the sample variance with unit weights
+        variance = (np.sum(weights.reshape(w_shape) * (trials-average)**2, axis=0)
+                    / (w_sum - np.sum(weights**2)/w_sum))
+        sem      = np.sqrt(variance * np.sum(weights**2)) / w_sum
+    if return_trials:
+        return average, sem, trials
+    return average, sem
+
+def peri_saccadic_response(spike_counts, eye_track, motion_threshold=5, window=15):
+    """
     Computes the cell average response around saccades.
 
     params:
@@ -809,19 +1235,9 @@ def peri_saccadic_response(spike_counts, eye_track, motion_threshold=5, window=1
         - peri saccadic response of cells of shape (n_cell, window*2+1)
     """
     eye_shifts = np.concatenate(([0],
-                                 np.linalg.norm(eye_tracking[1:,:2]-eye_tracking[:-1,:2], axis=1)))
-
-    #Because eye tracking is usually upsampled from 15 to 60Hz, it sums the shift, and smooth the peak
-    # detection
-    summed_shifts = np.convolve(eye_shifts, [1,1,1,1,1,1,1], mode="same")
-
-    peaks, res = signal.find_peaks(eye_shifts, height=motion_threshold, distance=10)
-    heights = res["peak_heights"] #Not used for now
-
-    psr = np.zeros((window*2, spike_bins.shape[1]))
-    for peak in peaks:
-        if peak<window or (peak+window)>len(spike_bins):
-            continue #Just ignoring peaks too close to the matrix edges
-        psr += spike_bins[peak-window:peak+window]
-    psr /= len(peaks)
-    return psr
\ No newline at end of file
+                                 np.linalg.norm(eye_track[1:,:2]-eye_track[:-1,:2], axis=1)))
+
+    peaks, _ = signal.find_peaks(eye_shifts, height=motion_threshold, distance=10)
+
+    psr, _ = event_triggered_average(traces=spike_counts, event_frames=peaks, pre=window, post=window+1)
+    return psr.T
\ No newline at end of file
@@ -9,17 +9,59 @@ import datetime
 import os, glob
 import csv
 import re
+import json
+from concurrent.futures import ProcessPoolExecutor
 
 from .io import *
 from ..utils import *
 
-def get_QDSpy_logs(log_dir):
-    """Factory function to generate QDSpy_log objects from all the QDSpy logs of the folder `log_dir`"""
+_QDSPY_DATA_ITEM = re.compile(r"'([^']*)'\s*:\s*('[^']*'|[^,}]*)") #'key': 'value' or 'key': value
+_QDSPY_DELAY     = re.compile(r"#(\d+)\s.*?was\s(\S+)")              #...frame #index ... was delay...
+_INDEX_TIME      = "%Y-%m-%dT%H:%M:%S.%f"                             #Times of the stimuli in the index
+
+def get_QDSpy_logs(log_dir, n_jobs=1, index_path=None):
+    """Factory function to generate QDSpy_log objects from all the QDSpy logs of the folder `log_dir`
+        - n_jobs: Number of processes parsing the logs in parallel (None for one per CPU)
+        - index_path: JSON file indexing the stimuli of the logs already parsed, with their modification time
+        and size. Only new or modified logs are parsed, and the index is then updated"""
     log_names = glob.glob(os.path.join(log_dir,'[0-9]*.log'))
-    qdspy_logs = [QDSpy_log(log_name) for log_name in log_names]
-    for qdspy_log in qdspy_logs:
-        qdspy_log.find_stimuli()
-    return qdspy_logs
+    index = {}
+    if index_path is not None and os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    qdspy_logs, to_parse = {}, []
+    for log_name in log_names:
+        log_stat = os.stat(log_name)
+        entry    = index.get(os.path.abspath(log_name))
+        if entry is not None and entry["mtime"]==log_stat.st_mtime_ns and entry["size"]==log_stat.st_size:
+            qdspy_logs[log_name] = QDSpy_log(log_name)
+            qdspy_logs[log_name].stimuli = [Stimulus.from_dict(stim_dict) for stim_dict in entry["stimuli"]]
+        else:
+            to_parse.append(log_name)
+
+    if n_jobs==1 or len(to_parse)<2:
+        parsed_logs = [_parse_QDSpy_log(log_name) for log_name in to_parse]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parsed_logs = list(executor.map(_parse_QDSpy_log, to_parse))
+    for qdspy_log in parsed_logs:
+        qdspy_logs[qdspy_log.log_path] = qdspy_log
+        log_stat = os.stat(qdspy_log.log_path)
+        index[os.path.abspath(qdspy_log.log_path)] = {"mtime": log_stat.st_mtime_ns, "size": log_stat.st_size,
+                                                      "stimuli": [stim.to_dict() for stim in qdspy_log.stimuli]}
+
+    if index_path is not None and len(parsed_logs)>0:
+        with open(index_path+".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path+".tmp", index_path)
+    return [qdspy_logs[log_name] for log_name in log_names]
+
+def _parse_QDSpy_log(log_path):
+    """Read the stimuli of a QDSpy log. At module level to be run by the processes of get_QDSpy_logs"""
+    qdspy_log = QDSpy_log(log_path)
+    qdspy_log.find_stimuli()
+    return qdspy_log
 
 class QDSpy_log:
     """Class defining a QDSpy log.
@@ -35,25 +77,15 @@ class QDSpy_log:
 
     def _extract_data(self, data_line):
         data = data_line[data_line.find('{')+1:data_line.find('}')]
-        data_splitted = data.split(',')
-        data_dict = {}
-        for data in data_splitted:
-            ind = data.find("'")
-            if type(data[data.find(":")+2:]) is str:
-                data_dict[data[ind+1:data.find("'",ind+1)]] = data[data.find(":")+2:][1:-1]
-            else:
-                data_dict[data[ind+1:data.find("'",ind+1)]] = data[data.find(":")+2:]
-        return data_dict
+        return {key: value[1:-1] if value.startswith("'") else value.strip()
+                for key, value in _QDSPY_DATA_ITEM.findall(data)}
 
     def _extract_time(self,data_line):
         return datetime.datetime.strptime(data_line.split()[0], '%Y%m%d_%H%M%S')
 
     def _extract_delay(self,data_line):
-        ind = data_line.find('#')
-        index_frame = int(data_line[ind+1:data_line.find(' ',ind)])
-        ind = data_line.find('was')
-        delay = float(data_line[ind:].split(" ")[1])
-        return (index_frame, delay)
+        index_frame, delay = _QDSPY_DELAY.search(data_line).groups()
+        return (int(index_frame), float(delay))
 
     def _extract_name_description(self, data_line):
         return data_line[data_line.find(':')+1:].strip()
@@ -72,6 +104,7 @@ class QDSpy_log:
     def find_stimuli(self):
         """Find the stimuli in the log file and return the list of the stimuli
         found by this object."""
+        stimulus_ON = False
         with open(self.log_path, 'r', encoding="ISO-8859-1") as log_file:
             for line in log_file:
                 if "Name       :" in line:
@@ -99,7 +132,7 @@ class QDSpy_log:
                         curr_stim.set_parameters(data_juice)
     #                elif 'probeX' in data_juice.keys():
             #            print("Probe center not implemented yet")
-                if "WARNING" in line and "dt of frame" and stimulus_ON:
+                if "WARNING" in line and "dt of frame" in line and stimulus_ON:
                     curr_stim.frame_delay.append(self._extract_delay(line))
                     if curr_stim.frame_delay[-1][1] > 2000/60: #if longer than 2 frames could be bad
                         print(curr_stim.name, " ".join(line.split()[1:])[:-1])
@@ -135,6 +168,27 @@ class Stimulus:
         if "stimFileName" in parameters.keys():
             self.filename = parameters["stimFileName"].split('\\')[-1]
 
+    def to_dict(self):
+        """Attributes of the stimulus as a JSON serializable dictionnary"""
+        return {"start_time": self.start_time.strftime(_INDEX_TIME),
+                "stop_time": None if self.stop_time is None else self.stop_time.strftime(_INDEX_TIME),
+                "parameters": self.parameters, "md5": self.md5, "name": self.name, "filename": self.filename,
+                "frame_delay": self.frame_delay, "is_aborted": self.is_aborted}
+
+    @classmethod
+    def from_dict(cls, stim_dict):
+        """Create back a Stimulus from the output of `to_dict`"""
+        stim = cls(datetime.datetime.strptime(stim_dict["start_time"], _INDEX_TIME))
+        if stim_dict["stop_time"] is not None:
+            stim.stop_time = datetime.datetime.strptime(stim_dict["stop_time"], _INDEX_TIME)
+        stim.parameters  = stim_dict["parameters"]
+        stim.md5         = stim_dict["md5"]
+        stim.name        = stim_dict["name"]
+        stim.filename    = stim_dict["filename"]
+        stim.frame_delay = [tuple(delay) for delay in stim_dict["frame_delay"]]
+        stim.is_aborted  = stim_dict["is_aborted"]
+        return stim
+
     def __str__(self):
         return "%s %s at %s" %(self.filename+" "*(24-len(self.filename)),self.md5,self.start_time)
 
@@ -181,42 +235,53 @@ def get_synced_file(stim_list_dir, stim_id):
     return stim, stim_path
 
 # Cell
-def unpack_stim_npy(npy_dir, md5_hash):
+def unpack_stim_npy(npy_dir, md5_hash, cache_dir=None):
     """Find the stimuli of a given hash key in the npy stimulus folder. The stimuli are in a compressed version
     comprising three files. inten for the stimulus values on the screen, marker for the values of the marker
     read by a photodiode to get the stimulus timing during a record, and an optional shader that is used to
-    specify informations about a shader when used, like for the moving gratings."""
+    specify informations about a shader when used, like for the moving gratings.
+    If `cache_dir` is given, the unpacked arrays are saved there as .npy under their hash key, and loaded
+    back as copy-on-write memory maps by the next calls with that hash: like the arrays of the first call,
+    they can be modified, without changing the cached files."""
+
+    if cache_dir is not None:
+        cache_fn = {ftype: os.path.join(cache_dir, md5_hash+"_"+ftype+"_unpacked.npy")
+                    for ftype in ["intensities", "marker", "shader"]}
+        if os.path.isfile(cache_fn["intensities"]) and os.path.isfile(cache_fn["marker"]):
+            shader_fn = cache_fn["shader"]
+            return (np.load(cache_fn["intensities"], mmap_mode="c"), np.load(cache_fn["marker"], mmap_mode="c"),
+                    np.load(shader_fn, mmap_mode="c") if os.path.isfile(shader_fn) else None)
 
     #Stimuli can be either npy or npz (useful when working remotely)
-    def find_file(ftype):
-        flist = glob.glob(os.path.join(npy_dir, "*_"+ftype+"_"+md5_hash+".npy"))
-        if len(flist)==0:
-            flist = glob.glob(os.path.join(npy_dir, "*_"+ftype+"_"+md5_hash+".npz"))
-            res = np.load(flist[0])["arr_0"]
-        else:
-            res = np.load(flist[0])
-        return res
-
-    inten  = find_file("intensities")
-    marker = find_file("marker")
-
-    shader, unpack_shader = None, None
-    if len(glob.glob(os.path.join(npy_dir, "*_shader_"+md5_hash+".np*")))>0:
-        shader        = find_file("shader")
-        unpack_shader = np.empty((np.sum(marker[:,0]), *shader.shape[1:]))
-
-    #The latter unpacks the arrays
-    unpack_inten  = np.empty((np.sum(marker[:,0]), *inten.shape[1:]))
-    unpack_marker = np.empty(np.sum(marker[:,0]))
-
-    cursor = 0
-    for i, n_frame in enumerate(marker[:,0]):
-        unpack_inten[cursor:cursor+n_frame] = inten[i]
-        unpack_marker[cursor:cursor+n_frame] = marker[i, 1]
-        if shader is not None:
-            unpack_shader[cursor:cursor+n_frame] = shader[i]
-        cursor += n_frame
-
+    stim_files = {}
+    for fn in sorted(glob.glob(os.path.join(npy_dir, "*_"+md5_hash+".np[yz]")), key=lambda fn: fn.endswith(".npz")):
+        ftype = os.path.basename(fn).split("_")[-2]
+        stim_files.setdefault(ftype, fn) #npy files come first
+    def load_file(ftype):
+        res = np.load(stim_files[ftype])
+        return res["arr_0"] if stim_files[ftype].endswith(".npz") else res
+
+    inten  = load_file("intensities")
+    marker = load_file("marker")
+    shader = load_file("shader") if "shader" in stim_files else None
+
+    #The latter unpacks the arrays, each value being repeated for its number of frames
+    n_frames      = marker[:,0].astype(int)
+    unpack_inten  = np.repeat(inten, n_frames, axis=0).astype(float, copy=False)
+    unpack_marker = np.repeat(marker[:,1], n_frames).astype(float, copy=False)
+    unpack_shader = None
+    if shader is not None:
+        unpack_shader = np.repeat(shader, n_frames, axis=0).astype(float, copy=False)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        #Intensities are written last, and each file is moved in place once complete, so that an interrupted
+        #caching is not mistaken for a cached stimulus
+        for ftype, unpacked in zip(["shader", "marker", "intensities"], [unpack_shader, unpack_marker, unpack_inten]):
+            if unpacked is not None:
+                with open(cache_fn[ftype]+".tmp", "wb") as f:
+                    np.save(f, unpacked)
+                os.replace(cache_fn[ftype]+".tmp", cache_fn[ftype])
     return unpack_inten, unpack_marker, unpack_shader
 
 # Cell
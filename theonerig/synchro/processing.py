@@ -1,17 +1,24 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 12_synchro.processing.ipynb (unless otherwise specified).
 
 __all__ = ['get_thresholds', 'get_first_high', 'detect_frames', 'reverse_detection', 'extend_timepoints', 'error_check',
-           'cluster_frame_signals', 'cluster_by_epochs', 'cluster_by_list', 'parse_time', 'get_position_estimate',
-           'match_starting_position', 'display_match', 'frame_error_correction', 'error_frame_matches', 'apply_shifts',
-           'shift_detection_conv', 'shift_detection_NW', 'chop_stim_edges', 'detect_calcium_frames']
+           'stream_frames', 'detect_frames_stream', 'cluster_frame_signals', 'cluster_by_epochs', 'cluster_by_list',
+           'parse_time', 'get_position_estimate', 'match_starting_position', 'match_starting_positions',
+           'frame_error_correction', 'error_frame_matches', 'apply_shifts', 'shift_detection_conv',
+           'shift_detection_NW', 'display_match', 'chop_stim_edges', 'detect_calcium_frames']
 
 # Cell
 import numpy as np
 import datetime
 import glob
 import os
+import bisect
+import logging
 from scipy import signal
 
+from ..utils import shift_index_map, sliding_windows
+
+_logger = logging.getLogger(__name__)
+
 # Cell
 def get_thresholds(data):
     """Function that attempts to get the high and low thresholds. Not working very well"""
@@ -42,7 +49,6 @@ def detect_frames(data, low_threshold, high_threshold, increment, do_reverse=Tru
 
     """
     assert (precision>0) and (precision<=1)
-    frame_timepoints, frame_signals = [], []
     increment      = int(increment)
     safe_increment = int(increment*precision)
 
@@ -51,11 +57,13 @@ def detect_frames(data, low_threshold, high_threshold, increment, do_reverse=Tru
         print("No high frame detected. Detection can't work.")
         return
 
-    frame_timepoints.append(first_high)
-    frame_signals.append(1)
+    frame_timepoints, frame_signals = [first_high], [1]
+    above_low = data > low_threshold
+    crossings = _rising_crossings(above_low)
 
     if do_reverse:
-        new_timepoints   = reverse_detection(data, frame_timepoints, low_threshold, increment, precision)
+        new_timepoints   = reverse_detection(data, frame_timepoints, low_threshold, increment, precision,
+                                             above_low=above_low, crossings=crossings)
         if len(new_timepoints)>1:
             new_extrapolated = extend_timepoints(new_timepoints)
         else:
@@ -63,19 +71,13 @@ def detect_frames(data, low_threshold, high_threshold, increment, do_reverse=Tru
         frame_timepoints = new_extrapolated + new_timepoints + frame_timepoints
         frame_signals    = [0]*(len(new_timepoints)+len(new_extrapolated)) + frame_signals
 
-    i = first_high + safe_increment
-    while i < len(data):
-        data_slice = data[i:i+increment//2+(increment-safe_increment)*2]
-        if np.any(data_slice>low_threshold):
-            i = i+np.argmax(data_slice>low_threshold)
-        else:
-            break #This frame sequence is over. Pass the next sequence through this function if there are frames left
-        frame_timepoints.append(i)
-        frame_signals.append(int(np.any(data_slice > high_threshold)))
-        i += safe_increment
+    window = increment//2+(increment-safe_increment)*2
+    new_timepoints, window_starts, _ = _threshold_walk(above_low, crossings, first_high + safe_increment,
+                                                       safe_increment, window)
+    new_signals = (_window_max(data, window_starts, window) > high_threshold).astype(int)
 
-    frame_timepoints = np.array(frame_timepoints)
-    frame_signals    = np.array(frame_signals)
+    frame_timepoints = np.array(frame_timepoints + new_timepoints)
+    frame_signals    = np.array(frame_signals + new_signals.tolist())
     frame_timepoints = frame_timepoints - 3 # A slight shift of the timepoints
                                             # to include the begginning of the peaks.
 
@@ -83,25 +85,69 @@ def detect_frames(data, low_threshold, high_threshold, increment, do_reverse=Tru
 
     return frame_timepoints, frame_signals
 
-def reverse_detection(data, frame_timepoints, low_threshold, increment, precision=.95):
-    """Detect frames in the left direction."""
-    new_timepoints = []
-    new_signals = []
-
+def reverse_detection(data, frame_timepoints, low_threshold, increment, precision=.95, above_low=None, crossings=None):
+    """Detect frames in the left direction. above_low and crossings can be passed to reuse the threshold
+    crossings computed by `detect_frames`."""
     safe_increment = int(increment * (1+(1-precision)))
+    if above_low is None:
+        above_low = data > low_threshold
+        crossings = _rising_crossings(above_low)
 
-    i = frame_timepoints[0]-safe_increment
-    while i>0:
-        data_slice = data[i:i+increment//2+(safe_increment-increment)*2]
-        if np.any(data_slice > low_threshold):
-            i = i+np.argmax(data_slice > low_threshold)
-        else:
-            break #No low threshold crossing found -> no more frames to detect
-        new_timepoints.append(i)
-        i-= safe_increment #We move backward of almost a frame
-
+    new_timepoints, _, _ = _threshold_walk(above_low, crossings, frame_timepoints[0]-safe_increment,
+                                           -safe_increment, increment//2+(safe_increment-increment)*2)
     return new_timepoints[::-1]
 
+def _rising_crossings(above):
+    """List of the indexes of the samples crossing the threshold (above the threshold when the previous one was bellow)."""
+    crossings = np.flatnonzero(np.diff(above.astype(np.int8)) > 0) + 1
+    if len(above) and above[0]:
+        crossings = np.concatenate(([0], crossings))
+    return crossings.tolist()
+
+def _threshold_walk(above, crossings, start, step, window, limit=None):
+    """Greedy pass over the threshold crossings: a frame is the first sample above the threshold in the window
+    starting at `start`, and the next window starts `step` samples after (or before if negative) that frame.
+    Stops when a window contains no sample above the threshold. If `limit` is given (number of samples
+    available), pauses before a window going past it.
+    Returns the frames, their window starts and the start of the paused window (None if the walk is over)."""
+    frames, window_starts = [], []
+    i = start
+    while i > 0:
+        if limit is not None and i + window > limit:
+            return frames, window_starts, i
+        if i >= len(above):
+            break
+        if above[i]: #Window starting during a frame
+            j = i
+        else:
+            k = bisect.bisect_left(crossings, i)
+            if k == len(crossings):
+                break
+            j = crossings[k]
+        if j >= i + window:
+            break #No threshold crossing found -> no more frames to detect
+        frames.append(j)
+        window_starts.append(i)
+        i = j + step
+    return frames, window_starts, None
+
+def _window_max(data, window_starts, window):
+    """Max of the data in each window [start, start+window), computed with np.maximum.reduceat. The windows
+    are split in groups where they don't overlap."""
+    window_starts = np.asarray(window_starts, dtype=int)
+    window_max    = np.empty(len(window_starts), dtype=data.dtype)
+    if len(window_starts)==0:
+        return window_max
+    min_step = np.min(np.diff(window_starts)) if len(window_starts)>1 else window
+    n_group  = int(np.ceil(window/min_step))
+    for g in range(n_group):
+        starts = window_starts[g::n_group]
+        bounds = np.stack([starts, np.minimum(starts+window, len(data))], axis=1).reshape(-1)
+        if bounds[-1] == len(data): #The last window goes to the end of the data
+            bounds = bounds[:-1]
+        window_max[g::n_group] = np.maximum.reduceat(data, bounds)[::2]
+    return window_max
+
 def extend_timepoints(frame_timepoints, n=10):
     """Extrapolates points to the left. Not really needed now except for the signals idx that would change
     otherwise (and some starting index were set manually)"""
@@ -121,13 +167,145 @@ def error_check(frame_tp):
         print("Error in timepoints detected in frames", np.where(error_frames)[0],
               "at timepoint", frame_tp[np.where(error_frames)[0]])
 
+class _ThresholdIntervals:
+    """Intervals of the samples above a threshold, built chunk by chunk. Can be indexed like the boolean array
+    data>threshold for the samples added so far, without keeping the data."""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.rises, self.falls = [], [] #Start and (exclusive) end of the intervals. The last one can be open
+        self.n_read   = 0
+        self.is_above = False
+
+    def add_chunk(self, chunk):
+        above = chunk > self.threshold
+        edges = np.flatnonzero(np.diff(above.astype(np.int8))) + 1
+        if len(above) and above[0] != self.is_above:
+            edges = np.concatenate(([0], edges))
+        edges = (edges + self.n_read).tolist()
+        if self.is_above:
+            self.falls.extend(edges[0::2]); self.rises.extend(edges[1::2])
+        else:
+            self.rises.extend(edges[0::2]); self.falls.extend(edges[1::2])
+        if len(above):
+            self.is_above = bool(above[-1])
+        self.n_read += len(above)
+
+    def any_in(self, start, length):
+        """True if a sample of [start, start+length) is above the threshold."""
+        k = bisect.bisect_right(self.falls, start)
+        return k < len(self.rises) and self.rises[k] < start+length
+
+    def drop_before(self, t):
+        """Forget the intervals ending before t."""
+        k = bisect.bisect_right(self.falls, t)
+        del self.rises[:k], self.falls[:k]
+
+    def __getitem__(self, i):
+        return self.any_in(i, 1)
+
+    def __len__(self):
+        return self.n_read
+
+def stream_frames(datafile, low_threshold, high_threshold, increment, do_reverse=True, precision=.95,
+                  channel_idx=0, chunk_size=1800960):
+    """Frame detection over the adc chunks of a datafile, that yields the frames as they are detected. Same
+    detection as `detect_frames`, but only the threshold crossings are kept in memory, not the data.
+        - datafile: DataFile to read the adc channel from (e.g. `RHDFile`, `RawBinaryFile`)
+        - low_threshold, high_threshold, increment, do_reverse, precision: see `detect_frames`
+        - channel_idx: Index of the adc channel
+        - chunk_size: Number of timepoints read at once
+
+    yield:
+        - frame_timepoints, frame_signals of the new frames detected in each chunk
+    """
+    assert (precision>0) and (precision<=1)
+    increment      = int(increment)
+    safe_increment = int(increment*precision)
+    window         = increment//2+(increment-safe_increment)*2
+    low_intervals, high_intervals = _ThresholdIntervals(low_threshold), _ThresholdIntervals(high_threshold)
+
+    datafile.open()
+    n_chunks, _ = datafile.analyze(chunk_size)
+    next_start  = None
+    for idx in range(n_chunks):
+        data_tmp, _ = datafile.get_data_adc(idx, chunk_size)
+        if data_tmp.ndim == 2:
+            data_tmp = data_tmp[:,channel_idx]
+        low_intervals.add_chunk(data_tmp)
+        high_intervals.add_chunk(data_tmp)
+        limit = None if idx==n_chunks-1 else low_intervals.n_read
+
+        frame_timepoints, frame_signals = [], []
+        if next_start is None: #First high frame not found yet
+            if len(high_intervals.rises)==0:
+                continue
+            first_high = high_intervals.rises[0]
+            frame_timepoints, frame_signals = [first_high], [1]
+            if do_reverse:
+                new_timepoints   = reverse_detection(None, frame_timepoints, low_threshold, increment, precision,
+                                                     above_low=low_intervals, crossings=low_intervals.rises)
+                new_extrapolated = extend_timepoints(new_timepoints) if len(new_timepoints)>1 else []
+                frame_timepoints = new_extrapolated + new_timepoints + frame_timepoints
+                frame_signals    = [0]*(len(new_timepoints)+len(new_extrapolated)) + frame_signals
+            next_start = first_high + safe_increment
+
+        new_timepoints, window_starts, next_start = _threshold_walk(low_intervals, low_intervals.rises, next_start,
+                                                                    safe_increment, window, limit=limit)
+        frame_timepoints += new_timepoints
+        frame_signals    += [int(high_intervals.any_in(i, window)) for i in window_starts]
+        yield np.array(frame_timepoints, dtype=int) - 3, np.array(frame_signals, dtype=int)
+        if next_start is None: #This frame sequence is over
+            break
+        low_intervals.drop_before(next_start-1)
+        high_intervals.drop_before(next_start-1)
+    datafile.close()
+
+def detect_frames_stream(datafile, low_threshold, high_threshold, increment, do_reverse=True, precision=.95,
+                         channel_idx=0, chunk_size=1800960):
+    """Same as `detect_frames`, but reading the adc channel of the datafile by chunks with `stream_frames`,
+    without loading the whole channel in memory."""
+    detected = list(stream_frames(datafile, low_threshold, high_threshold, increment, do_reverse=do_reverse,
+                                  precision=precision, channel_idx=channel_idx, chunk_size=chunk_size))
+    if len(detected)==0:
+        print("No high frame detected. Detection can't work.")
+        return
+    frame_timepoints = np.concatenate([tp for tp, _ in detected])
+    frame_signals    = np.concatenate([sig for _, sig in detected])
+
+    error_check(frame_timepoints)
+
+    return frame_timepoints, frame_signals
+
 # Cell
+def _frame_aucs(data, frame_timepoints):
+    """Trapezoid AUC of the data between each frame timepoint, equivalent to mapping np.trapz over
+    np.split(data, frame_timepoints) (the first value is the part before the first timepoint). Computed with
+    np.add.reduceat and corrections of the segments endpoints, accumulated in float so that integer adc traces
+    don't overflow."""
+    bounds  = np.concatenate(([0], frame_timepoints, [len(data)])).astype(int)
+    starts, stops = bounds[:-1], bounds[1:]
+    frame_aucs = np.zeros(len(starts))
+    valid   = (stops - starts) > 1 #trapz of less than two points is 0
+    starts, stops = starts[valid], stops[valid]
+    if len(starts)==0:
+        return frame_aucs
+    idx = np.stack([starts, stops], axis=1).reshape(-1)
+    if idx[-1] == len(data): #The last segment goes to the end of the data
+        idx = idx[:-1]
+    endpoints = data[starts].astype(float) + data[stops-1]
+    frame_aucs[valid] = np.add.reduceat(data, idx, dtype=float)[::2] - endpoints/2
+    return frame_aucs
+
+def _auc_thresholds_labels(frame_aucs, thresholds):
+    """Labels of the frames: number of (sorted) thresholds bellow each frame AUC."""
+    return np.searchsorted(thresholds, frame_aucs, side="left")
+
 def cluster_frame_signals(data, frame_timepoints, n_cluster=5):
     """Cluster the `frame_timepoints` in `n_cluster` categories depending on the area under the curve.
         - data: raw data used to compute the AUC
         - frame_timepoints: timepoints delimitating each frame
         - n_cluster: Number of cluster for the frame signals"""
-    frame_aucs = np.fromiter(map(np.trapz, np.split(data, frame_timepoints)), float)
+    frame_aucs = _frame_aucs(data, frame_timepoints)
     if frame_timepoints[0] != 0: #We need to remove the first part if it wasn't a full frame
         frame_aucs = frame_aucs[1:]
     frame_auc_sorted = np.sort(frame_aucs)
@@ -152,13 +330,13 @@ def cluster_frame_signals(data, frame_timepoints, n_cluster=5):
     for i, idx in enumerate(idx_gaps):
         thresholds[i] = (frame_auc_sorted[idx+1] + frame_auc_sorted[idx])/2
 
-    return np.array([np.sum(auc>thresholds) for auc in frame_aucs], dtype=int)
+    return _auc_thresholds_labels(frame_aucs, thresholds).astype(int)
 
 def cluster_by_epochs(data, frame_timepoints, frame_signals, epochs):
     """Does the same thing as `cluster_frame_signals`, but working on epochs around which the
     number of cluster can differ. Useful when a record contains stimuli with different signals sizes."""
 
-    frame_aucs = np.fromiter(map(np.trapz, np.split(data, frame_timepoints)), float)
+    frame_aucs = _frame_aucs(data, frame_timepoints)
     if frame_timepoints[0] != 0: #We need to remove the first part if it wasn't a full frame
         frame_aucs = frame_aucs[1:]
 
@@ -182,7 +360,7 @@ def cluster_by_epochs(data, frame_timepoints, frame_signals, epochs):
         for i, idx in enumerate(idx_gaps):
             thresholds[i] = (frame_auc_sorted[idx+1] + frame_auc_sorted[idx])/2
 
-        frame_signals[start:stop] = np.array([np.sum(auc>thresholds)*norm_clust for auc in frame_aucs[start:stop]], dtype=int)
+        frame_signals[start:stop] = (_auc_thresholds_labels(frame_aucs[start:stop], thresholds)*norm_clust).astype(int)
     return frame_signals
 
 # Cell
@@ -246,24 +424,69 @@ def match_starting_position(frame_timepoints, frame_signals, stim_signals, estim
     return:
         - best match for the starting position of the stimulus
     """
-    stim_matching_len = min(600, np.where(np.diff(stim_signals)!=0)[0][50]) #Way of getting the 50th change in the signals
-    idx_estimate = np.argmax(frame_timepoints>estimate_start)
-    search_slice = slice(max(0, idx_estimate-search_size-frame_signals.idx), min(idx_estimate+search_size-frame_signals.idx, len(frame_signals)))
-    return search_slice.start + np.argmax(np.correlate(frame_signals[search_slice],
-                                                       stim_signals[:stim_matching_len]))
+    positions, _, _ = match_starting_positions(frame_timepoints, frame_signals, [stim_signals], [estimate_start],
+                                               search_size=search_size)
+    return positions[0]
 
-
-# Cell
-def display_match(match_position, reference=None, recorded=None, corrected=None, len_line=50):
-    start, mid, end = 0, len(reference)//2, len(reference)-len_line
-    for line in [start, mid, end]:
-        if reference is not None:
-            print("REF ["+str(line)+"] "," ".join(map(str,map(int, reference[line:line+len_line]))))
-        if recorded is not None:
-            print("REC ["+str(line)+"] "," ".join(map(str,map(int, recorded[line+match_position:line+len_line+match_position]))))
-        if corrected is not None:
-            print("COR ["+str(line)+"] "," ".join(map(str,map(int, corrected[line:line+len_line]))))
-        print()
+def match_starting_positions(frame_timepoints, frame_signals, stims_signals, estimate_starts, search_size=1000,
+                             min_separation=5):
+    """
+    Search the best matching index between frame_signals and the signals of multiple stimuli. The record
+    spanning all the search windows is transformed by a single FFT, and the correlations of each stimulus
+    are obtained from its product with the transform of the stimulus signals.
+    params:
+        - frame_timepoints: Indexes of the frames in the record
+        - frame_signals: Signals of the detected frames
+        - stims_signals: List of the expected stimuli signals
+        - estimate_starts: List of the estimated start index of each stimulus
+        - search_size: Stimuli are searched in frame_signals[idx_estimate-search_size: idx_estimate+search_size]
+        - min_separation: Minimum distance in frames from the best match to look for the second best match
+    return:
+        - best match for the starting position of each stimulus (maximum of the correlation)
+        - match scores: correlation at the best match, relative to the correlation of the stimulus signals
+        with themselves (1 for a perfect match of a record having the same values)
+        - ambiguity margins: relative correlation difference with the second best match, at least
+        `min_separation` frames away. Low margins flag unreliable matches
+    """
+    chunk_idx     = getattr(frame_signals, "idx", 0)
+    frame_signals = np.asarray(frame_signals, dtype=float)
+    templates, windows = [], []
+    for stim_signals, estimate_start in zip(stims_signals, estimate_starts):
+        changes = np.where(np.diff(stim_signals)!=0)[0]
+        stim_matching_len = min(600, changes[50] if len(changes)>50 else len(stim_signals)) #Way of getting the 50th change in the signals
+        idx_estimate = np.argmax(frame_timepoints>estimate_start)
+        start = max(0, idx_estimate-search_size-chunk_idx)
+        stop  = min(idx_estimate+search_size-chunk_idx, len(frame_signals))
+        assert stop-start >= stim_matching_len, "Search window shorter than the stimulus signals to match"
+        templates.append(np.asarray(stim_signals[:stim_matching_len], dtype=float))
+        windows.append((start, stop-stim_matching_len+1)) #Starting positions where the whole template fits
+
+    #Single transform of the record part covering all the search windows. As the transform is at least as
+    # long as that part, the circular correlation doesn't wrap around for the starting positions searched
+    origin   = min(first for first, _ in windows)
+    end      = max(last+len(t)-1 for t, (_, last) in zip(templates, windows))
+    recorded = frame_signals[origin:end]
+    n_fft    = 2**int(np.ceil(np.log2(len(recorded))))
+    rec_fft  = np.fft.rfft(recorded, n_fft)
+    #If the signals are integers, the correlations too: rounding them keeps the np.correlate tie breaking
+    is_integer = np.all(np.mod(recorded, 1)==0) and all(np.all(np.mod(t, 1)==0) for t in templates)
+
+    positions, scores, margins = [], [], []
+    for template, (first, last) in zip(templates, windows):
+        correlation = np.fft.irfft(rec_fft * np.conj(np.fft.rfft(template, n_fft)), n_fft)[first-origin:last-origin]
+        if is_integer:
+            correlation = np.rint(correlation)
+
+        best   = np.argmax(correlation)
+        second = max([np.max(part) for part in (correlation[:max(0, best-min_separation+1)],
+                                                correlation[best+min_separation:]) if len(part)>0],
+                     default=0)
+        t_norm = max(np.dot(template, template), 1e-12)
+        positions.append(first+best)
+        scores.append(correlation[best]/t_norm)
+        margins.append((correlation[best]-second)/t_norm)
+
+    return np.array(positions), np.array(scores), np.array(margins)
 
 # Cell
 def frame_error_correction(signals, unpacked, algo="nw", **kwargs):
@@ -298,91 +521,94 @@ def frame_error_correction(signals, unpacked, algo="nw", **kwargs):
     return (intensity, marker, shader), shift_log, list(zip(map(int,error_frames), map(int,replacements)))
 
 def error_frame_matches(signals, marker, range_):
-    """Find the frames mismatching and finds in the record the closest frame with an identical signal value"""
+    """Find the frames mismatching and finds in the record the closest frame with an identical signal value.
+    For all mismatching frames at once, the marker values within `range_` are compared to the signal, and the
+    closest equal one is taken (the earlier one in case of a tie). Frames closer than `range_` to the start
+    of the record are not replaced."""
     error_frames = np.nonzero(signals!=marker)[0]
-    if len(error_frames)>0:
-        where_equal = [((np.where(marker[err_id-range_:err_id+(range_+1)] == signals[err_id])[0]) - range_) for err_id in error_frames]
-    #filtering out the frames where no match was found
-        tmp    = np.array([[wheq,err] for (wheq, err) in zip(where_equal, error_frames) if len(wheq)>0])
-        if len(tmp)==0:
-            replacements = np.empty(shape=(0,), dtype=int)
-            error_frames = np.empty(shape=(0,), dtype=int)
-        else:
-            where_equal  = tmp[:,0]
-            error_frames = tmp[:,1]
-
-        #Choosing among the equal frame signals the one that is the closest
-            closest_equal = [wheq[(np.abs(wheq)).argmin()] for wheq in where_equal]
-            error_frames  = np.array(error_frames, dtype=int)
-            replacements  = error_frames + np.array(closest_equal, dtype=int)
-    else:
-        replacements = np.empty(shape=(0,), dtype=int)
-        error_frames = np.empty(shape=(0,), dtype=int)
+    offsets      = np.arange(-range_, range_+1)
+    padded       = np.concatenate((np.zeros(range_, dtype=marker.dtype), marker, np.zeros(range_, dtype=marker.dtype)))
+    windows      = sliding_windows(padded, range_*2+1)[error_frames] #marker[err-range_:err+range_+1]
+    is_equal     = (windows == signals[error_frames,None])
+    is_equal    &= (error_frames[:,None] >= range_) & (error_frames[:,None]+offsets < len(marker))
+
+    #Filtering out the frames where no match was found, and choosing the closest equal frame signal
+    has_match     = np.any(is_equal, axis=1)
+    closest_equal = offsets[np.where(is_equal, np.abs(offsets), range_+1).argmin(axis=1)]
+    error_frames  = error_frames[has_match].astype(int)
+    replacements  = error_frames + closest_equal[has_match]
 
     return error_frames, replacements
 
 def apply_shifts(unpacked, op_log):
     """Applies the shifts found by either shift_detection functions"""
-    inten, marker, shader = unpacked[0].copy(), unpacked[1].copy(), unpacked[2]
-    if shader is not None:
-        shader = shader.copy()
-    orig_len = len(marker)
-    for idx, op in op_log:
-        if op=="ins": #We insert a frame
-            marker = np.insert(marker, idx, marker[idx], axis=0)
-            inten  = np.insert(inten , idx, inten[idx], axis=0)
-            if shader is not None:
-                shader = np.insert(shader, idx, shader[idx], axis=0)
-        elif op=="del": #We concatenate without the deleted frame
-            marker = np.concatenate((marker[:idx],marker[idx+1:]))
-            inten  = np.concatenate((inten[:idx],inten[idx+1:]))
-            if shader is not None:
-                shader = np.concatenate((shader[:idx],shader[idx+1:]))
-    marker = marker[:orig_len]
-    inten  = inten[:orig_len]
-    if shader is not None:
-        shader = shader[:orig_len]
+    index_map = shift_index_map(op_log, len(unpacked[1]))
+    inten, marker, shader = [None if arr is None else np.take(arr, index_map, axis=0) for arr in unpacked]
     return (inten, marker, shader)
 
-def shift_detection_conv(signals, marker, range_):
+def shift_detection_conv(signals, marker, range_, chunk_size=256):
     """Detect shifts with a convolution method. First look at how far the next closest frame are, and average
-    it over the record. When the average cross the -1 or 1 threshold, shift the reference accordingly."""
-    marker = marker.copy()
-    shift_detected = True
-    shift_log = []
-    while shift_detected:
-        error_frames, replacements = error_frame_matches(signals, marker, range_)
-
-        all_shifts = np.zeros(len(marker))
-        all_shifts[error_frames] = replacements-error_frames
-        all_shifts_conv = np.convolve(all_shifts, [1/20]*20, mode="same") #Averaging the shifts to find consistant shifts
+    it over the record. When the average cross the -1 or 1 threshold, shift the reference accordingly.
+    The record is evaluated by chunks of `chunk_size` frames, and after each shift only the mismatches and
+    averages from the shift onwards are re-evaluated. The number of passes (one per shift plus the final one)
+    and of frames examined are sent to the module logger at the debug level."""
+    marker     = marker.copy()
+    n          = len(marker)
+    all_shifts = np.zeros(n)
+    shift_log  = []
+    n_pass, n_examined = 1, 0
+    start, valid = 0, 0 #The average is checked from start. all_shifts is up to date until valid
+    while start < n:
+        stop   = min(n, start+chunk_size)
+        needed = min(n, stop+9) #The average of a frame uses the shifts from 10 frames before to 9 frames after
+        if needed > valid:
+            lo      = max(0, valid-range_)
+            hi      = max(needed+range_, lo+range_*2+1)
+            error_frames, replacements = error_frame_matches(signals[lo:hi], marker[lo:hi], range_)
+            to_keep = (error_frames+lo >= valid) & (error_frames+lo < needed)
+            all_shifts[valid:needed] = 0
+            all_shifts[error_frames[to_keep]+lo] = (replacements-error_frames)[to_keep]
+            n_examined += needed-valid
+            valid       = needed
+        conv_start = max(0, min(start-10, valid-20)) #np.convolve "same" returns max(len) values
+        all_shifts_conv = np.convolve(all_shifts[conv_start:valid], [1/20]*20, mode="same") #Averaging the shifts to find consistant shifts
+        all_shifts_conv = all_shifts_conv[start-conv_start:stop-conv_start]
 
         shift_detected = np.any(np.abs(all_shifts_conv)>.5)
-        if shift_detected: #iF the -.5 threshold is crossed, we insert a "fake" frame in the reference and we repeat the operation
-            change_idx = np.argmax(np.abs(all_shifts_conv)>.5)
-            if all_shifts_conv[change_idx]>.5:#Need to delete frame in reference
-                #Need to refine index to make sure we delete a useless frame
-                start,stop = max(0,change_idx-2), min(len(marker),change_idx+2)
-                for i in range(start,stop):
-                    if marker[i] not in signals[start:stop]:
-                        change_idx = i
-                        break
-                shift_log.append([int(change_idx), "del"])
-                marker = np.concatenate((marker[:change_idx], marker[change_idx+1:], [0]))
-            else:#Need to insert frame in reference
-                shift_log.append([int(change_idx), "ins"])
-                #inserting a frame and excluding the last frame to keep the references the same length
-                marker     = np.insert(marker, change_idx, marker[change_idx], axis=0)[:-1]
+        if not shift_detected:
+            start = stop
+            continue
+        #iF the -.5 threshold is crossed, we insert a "fake" frame in the reference and we repeat the operation
+        n_pass    += 1
+        change_idx = start + np.argmax(np.abs(all_shifts_conv)>.5)
+        if all_shifts_conv[change_idx-start]>.5:#Need to delete frame in reference
+            #Need to refine index to make sure we delete a useless frame
+            near_start, near_stop = max(0,change_idx-2), min(len(marker),change_idx+2)
+            for i in range(near_start, near_stop):
+                if marker[i] not in signals[near_start:near_stop]:
+                    change_idx = i
+                    break
+            shift_log.append([int(change_idx), "del"])
+            marker = np.concatenate((marker[:change_idx], marker[change_idx+1:], [0]))
+        else:#Need to insert frame in reference
+            shift_log.append([int(change_idx), "ins"])
+            #inserting a frame and excluding the last frame to keep the references the same length
+            marker     = np.insert(marker, change_idx, marker[change_idx], axis=0)[:-1]
+        #Only the frames affected by the change need to be re-evaluated
+        valid = min(valid, max(0, change_idx-range_))
+        start = max(0, valid-9)
+    _logger.debug("%d passes, %d frames examined for a record of %d frames", n_pass, n_examined, n)
     return shift_log
 
 def shift_detection_NW(signals, marker, simmat_basis=[1,-1,-3,-3,-1], insdel=-10, rowside=20):
     """Memory optimized Needleman-Wunsch algorithm.
-    Instead of an N*N matrix, it uses a N*(side*2+1) matrix. Indexing goes slightly differently but
-    result is the same, with far less memory consumption and exection speed scaling better with
-    size of the sequences to align."""
-    #Setting the similarity matrix
-    side = rowside
-    sim_mat = np.empty((len(marker), side*2+1), dtype="int32")
+    Instead of an N*N matrix, it uses a N*(side*2+1) band, `rowside` setting the band half-width (the
+    maximum drift between the two sequences). Each row of the band is filled at once: match and delete
+    scores come from the previous row, and the insert chain along the row is resolved with a running max.
+    The moves for the traceback are then derived from the scores for the whole band at once."""
+    side    = rowside
+    width   = side*2+1
+    n       = len(marker)
     #Setting the errors
     insertion_v = insdel #insertions are commons not so high penalty
     deletion_v  = insdel #deletions detection happens during periods of confusion but are temporary. High value
@@ -391,50 +617,61 @@ def shift_detection_NW(signals, marker, simmat_basis=[1,-1,-3,-3,-1], insdel=-10
     for i in range(len(simmat_basis)):
         error_mat[i] = np.roll(error_match,i)
 
-    #Filling the similarity matrix
-    sim_mat[0, side] = error_mat[marker[0], signals[0]]
-    #Initialization: Setting the score of the first few row and first few column cells
-    for j in range(side+1, side*2+1):
-        sim_mat[0,j] = sim_mat[0,side] + insertion_v*j
-    for i in range(1, side+1):
-        sim_mat[i,side-i] = sim_mat[0,side] + deletion_v*i
-
-    #Corpus: if j is the first cell of the row, the insert score is set super low
-    #        if j is the last  cell of the row, the delete score is set super low
-    for i in range(1, sim_mat.shape[0]):
-        start = max(side-i+1, 0)
-        stop  = min(side*2+1, side+sim_mat.shape[0]-i)
-        for j in range(start, stop):
-            if j==0:#j==start and i>side:
-                insert = -99999
-                delete = sim_mat[i-1, j+1] + deletion_v
-            elif j==side*2:
-                delete = -99999
-                insert = sim_mat[i, j-1] + insertion_v
-            else:
-                insert = sim_mat[i, j-1] + insertion_v
-                delete = sim_mat[i-1, j+1] + deletion_v
-            match  = sim_mat[i-1, j] + error_mat[marker[i], signals[j+i-side]]
-            sim_mat[i,j] = max(insert,delete,match)
-
-    #Reading the similarity matrix
+    #Match scores of the whole band: row i, column j compares marker[i] with signals[i+j-side]
+    sig_idx  = np.arange(n)[:,None] + np.arange(-side, side+1)[None,:]
+    in_range = (sig_idx>=0) & (sig_idx<min(n, len(signals)))
+    match_sc = error_mat[marker[:,None], signals[np.clip(sig_idx, 0, len(signals)-1)]]
+    match_sc[~in_range] = -np.inf
+
+    scores  = np.full((n, width+1), -np.inf) #Extra column on the right: no delete from the last column
+    ins_pos = insertion_v*np.arange(width)
+    #Initialization: first row only reached by insertions
+    scores[0, side] = match_sc[0, side]
+    scores[0, side+1:width] = scores[0, side] + insertion_v*np.arange(side+1, width)
+
+    #Corpus: outside of the band (or of the sequences) scores stay at -inf
+    for i in range(1, n):
+        row = np.maximum(scores[i-1,:-1] + match_sc[i], scores[i-1,1:] + deletion_v)
+        row = np.maximum.accumulate(row - ins_pos) + ins_pos #Insert: row[j] = max_k<=j(row[k] + ins*(j-k))
+        scores[i,:min(width, side+n-i)] = row[:side+n-i]
+
+    #Moves taken to reach each cell, in the traceback order of preference: 0:match, 1:delete, 2:insert
+    moves = np.full((n, width), 2, dtype="int8")
+    moves[1:][scores[1:,:-1] == scores[:-1,1:] + deletion_v]     = 1
+    moves[1:][scores[1:,:-1] == scores[:-1,:-1] + match_sc[1:]]  = 0
+
+    #Reading the moves
     #In general, it's the same, at the difference that when i decrement, must add 1 to j compared to usual.
-    i = len(marker)-1
+    i = n-1
     j = side
     shift_log = []
     while (i > 0 or j>side-i):
-        if (i > 0 and j>side-i and sim_mat[i,j]==(sim_mat[i-1,j]+error_mat[marker[i], signals[j+i-side]])):
+        move = moves[i,j]
+        if move==0:
             i -= 1
-        elif(i > 0 and sim_mat[i,j] == sim_mat[i-1,j+1] + deletion_v):
-            shift_log.insert(0,(j+i-side+1, "del")) #Insert the j value for deletion too because all shifts
-            i-=1                                        #are relative to the signals recorded, unlike normal NW
-            j+=1
+        elif move==1:
+            shift_log.append((j+i-side+1, "del")) #Insert the j value for deletion too because all shifts
+            i -= 1                                #are relative to the signals recorded, unlike normal NW
+            j += 1
         else:
-            shift_log.insert(0,(j+i-side, "ins"))
-            j-=1
+            shift_log.append((j+i-side, "ins"))
+            j -= 1
+    shift_log.reverse()
 
     return shift_log
 
+# Cell
+def display_match(match_position, reference=None, recorded=None, corrected=None, len_line=50):
+    start, mid, end = 0, len(reference)//2, len(reference)-len_line
+    for line in [start, mid, end]:
+        if reference is not None:
+            print("REF ["+str(line)+"] "," ".join(map(str,map(int, reference[line:line+len_line]))))
+        if recorded is not None:
+            print("REC ["+str(line)+"] "," ".join(map(str,map(int, recorded[line+match_position:line+len_line+match_position]))))
+        if corrected is not None:
+            print("COR ["+str(line)+"] "," ".join(map(str,map(int, corrected[line:line+len_line]))))
+        print()
+
 # Cell
 def chop_stim_edges(first_frame, last_frame, stim_tuple, shift_log, frame_replacement):
     """Cut out the stimulus parts not containing actual stimulus, and change the idx values of `shift_log`
@@ -1,11 +1,11 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: 01_utils.ipynb (unless otherwise specified).
 
 __all__ = ['extend_sync_timepoints', 'align_sync_timepoints', 'resample_to_timepoints', 'link_sync_timepoints',
-           'flip_stimulus', 'flip_gratings', 'stim_to_dataChunk', 'phy_results_dict', 'spike_to_dataChunk',
-           'get_calcium_stack_lenghts', 'twoP_dataChunks', 'img_2d_fit', 'fill_nan', 'stim_inten_norm',
-           'group_direction_response', 'group_chirp_bumps', 'get_repeat_corrected', 'removeSlowDrift',
-           'time_shift_test_corr', 'cross_corr_with_lag', 'get_inception_generator', 'group_omitted_epochs',
-           'get_shank_channels', 'format_pval', 'stim_recap_df']
+           'shift_index_map', 'flip_stimulus', 'flip_gratings', 'stim_to_dataChunk', 'phy_results_dict',
+           'spike_to_dataChunk', 'get_calcium_stack_lenghts', 'twoP_dataChunks', 'img_2d_fit', 'img_2d_fits',
+           'fill_nan', 'stim_inten_norm', 'sliding_windows', 'group_direction_response', 'group_chirp_bumps',
+           'get_repeat_corrected', 'removeSlowDrift', 'time_shift_test_corr', 'cross_corr_with_lag',
+           'get_inception_generator', 'group_omitted_epochs', 'get_shank_channels', 'format_pval', 'stim_recap_df']
 
 # Cell
 import numpy as np
@@ -194,6 +194,51 @@ def link_sync_timepoints(frame_tp_1, frame_sig_1, frame_tp_2, frame_sig_2):
 
     return concat_frame_tp, concat_frame_sig
 
+# Cell
+def shift_index_map(shift_log, length, keep_length=False):
+    """
+    Convert a shift log (from the synchro shift detection) to the index map of the frames, such that
+    the shifted array is `array[index_map]`.
+
+    params:
+        - shift_log: List of (idx, op), with op "ins" to duplicate the frame idx and "del" to remove it.
+        Indexes are relative to the sequence with the previous operations applied.
+        - length: Length of the sequence before the shifts
+        - keep_length: If False, the sequence grows and shrinks with the operations and is cut to `length`
+        at the end. If True, each operation keeps the sequence at `length`: insertions drop the last frame,
+        deletions repeat the previous last frame (or add an empty frame, indexed -1, before any insertion).
+
+    return:
+        - Index map of the frames of the shifted sequence
+    """
+    runs    = [[0, length]] #Consecutive frames [start, n_frames] of the shifted sequence
+    any_ins = False
+    for idx, op in shift_log:
+        pos = 0
+        for i_run, (start, n_frames) in enumerate(runs):
+            if idx < pos+n_frames:
+                break
+            pos += n_frames
+        else:
+            raise IndexError("Shift index %d out of bound for a sequence of %d frames" % (idx, pos))
+        assert idx >= 0, "Shift index must be positive"
+        offset = idx - pos
+        last   = runs[-1][0] + runs[-1][1] - 1
+        if op=="ins": #The frame idx is repeated
+            runs[i_run:i_run+1] = [[start, offset], [start+offset, 1], [start+offset, n_frames-offset]]
+            any_ins = True
+            if keep_length:
+                runs[-1][1] -= 1
+        else: #The frame idx is removed
+            runs[i_run:i_run+1] = [[start, offset], [start+offset+1, n_frames-offset-1]]
+            if keep_length:
+                runs.append([last if any_ins else -1, 1])
+        runs = [r for r in runs if r[1]>0]
+
+    starts, n_frames = np.array(runs, dtype=int).reshape(-1,2).T
+    index_map = np.repeat(starts - (np.cumsum(n_frames)-n_frames), n_frames) + np.arange(np.sum(n_frames))
+    return index_map[:length]
+
 # Cell
 def flip_stimulus(stim_inten, ud_inv, lr_inv):
     """
@@ -368,6 +413,27 @@ def img_2d_fit(shape, param_d, f):
     xy = np.meshgrid(range(x_), range(y_))
     return f(xy, **param_d).reshape(y_, x_)
 
+def img_2d_fits(shape, param_ds, f):
+    """
+    Helper function to generate the 2D images of multiple fits at once, evaluated on a shared grid.
+
+    params:
+        - shape: Shape of the images in (y, x).
+        - param_ds: List of fit dictionnaries, all with the same keys.
+        - f: Function used of the fit. Must broadcast its parameters, like `gaussian_2D`.
+
+    return:
+        - Images of the fits of shape (n_fit, y, x)
+    """
+    y_, x_ = shape
+    if len(param_ds)==0:
+        return np.empty((0, y_, x_))
+    #The grid is tiled and the parameters repeated so that all fits are evaluated in one flat call
+    xy = [np.tile(coord.ravel(), len(param_ds)) for coord in np.meshgrid(range(x_), range(y_))]
+    params = {key: np.repeat(np.array([param_d[key] for param_d in param_ds], dtype=float), y_*x_)
+              for key in param_ds[0].keys()}
+    return f(xy, **params).reshape(len(param_ds), y_, x_)
+
 # Cell
 def fill_nan(A):
     """
@@ -380,15 +446,45 @@ def fill_nan(A):
     return B
 
 # Cell
-def stim_inten_norm(stim_inten):
+def stim_inten_norm(stim_inten, dtype=None):
     """
     Normalize a stimulus with intensity in the 8bit range (0-255) to -1 to 1 range.
+
+    params:
+        - stim_inten: Stimulus intensity matrix of shape (t, ...)
+        - dtype: Reduced precision to normalize with (e.g. "float32"). In that case, stimuli with values only
+        in {-1, 0, 1} (checkerboards, flickers) are returned as int8. If None, float64 is used.
+
+    return:
+        - Normalized stimulus intensity
     """
-    stim_inten = stim_inten.astype(float)
+    if dtype is None:
+        dtype = float
+    stim_inten = stim_inten.astype(dtype)
     stim_inten -= np.min(stim_inten)
     stim_inten -= np.max(stim_inten)/2
     stim_inten /= np.max(np.abs(stim_inten))
-    return np.round(stim_inten, 5)
+    stim_inten = np.round(stim_inten, 5)
+    if np.dtype(dtype) != np.float64 and np.all(stim_inten == np.trunc(stim_inten)):
+        stim_inten = stim_inten.astype("int8") #Ternary stimulus
+    return stim_inten
+
+# Cell
+def sliding_windows(array, window):
+    """
+    Read-only view of the sliding windows of an array along its first axis, without copying it.
+
+    params:
+        - array: Array of shape (t, ...)
+        - window: Length of the windows
+
+    return:
+        - View of shape (t-(window-1), window, ...), where element i is array[i:i+window]
+    """
+    array = np.asarray(array)
+    shape = (max(0, len(array)-window+1), window) + array.shape[1:]
+    return np.lib.stride_tricks.as_strided(array, shape=shape, strides=(array.strides[0],)+array.strides,
+                                           writeable=False)
 
 # Cell
 def group_direction_response(stim_prop, spike_counts, n_repeat, n_cond=32):
@@ -502,16 +598,11 @@ def get_repeat_corrected(stim_inten, spike_counts, n_repeats=10):
     signal_shifts     = stim_inten.attrs["signal_shifts"]
     frame_replacement = stim_inten.attrs["frame_replacement"]
 
-    spike_count_corr = spike_counts.copy()
-    shift_cursor = 0
-    prev_del = np.zeros((1, spike_counts.shape[1]))
-    for shift, direction in signal_shifts:
-        if direction=="ins":
-            spike_count_corr[shift+1:] = spike_count_corr[shift:-1]
-            prev_del = spike_count_corr[-1:]
-        else:
-            spike_count_corr[shift-1:-1] = spike_count_corr[shift:]
-            spike_count_corr[-1:] = prev_del
+    #Here deletions at shift remove the frame before it
+    shift_log = [(shift, "ins") if direction=="ins" else (shift-1, "del") for shift, direction in signal_shifts]
+    index_map = shift_index_map(shift_log, len(spike_counts), keep_length=True)
+    spike_count_corr = np.take(spike_counts, index_map, axis=0)
+    spike_count_corr[index_map==-1] = 0 #Frames deleted before any insertion are replaced by empty frames
 
     len_epoch = len(stim_inten)//n_repeats
     spike_counts_corrected = []